@@ -9,10 +9,10 @@ from flask_mail import Mail
 from flask_bootstrap import Bootstrap
 from flask_moment import Moment
 from flask_babel import Babel
-from elasticsearch import Elasticsearch
 from config import Config
+from app.database import RoutingSession, configure_engines, init_engines
 
-db = SQLAlchemy()
+db = SQLAlchemy(session_options={'class_': RoutingSession})
 migrate = Migrate()
 login = LoginManager()
 login.login_view = 'auth.login'
@@ -25,7 +25,9 @@ def create_app(config_class=Config):
     app = Flask(__name__)
     app.config.from_object(config_class)
 
+    configure_engines(app)
     db.init_app(app)
+    init_engines(app, db)
     migrate.init_app(app, db)
     login.init_app(app)
     mail.init_app(app)
@@ -33,8 +35,31 @@ def create_app(config_class=Config):
     moment.init_app(app)
     babel.init_app(app)
 
-    app.elasticsearch = Elasticsearch([app.config['ELASTICSEARCH_URL']]) \
-        if app.config['ELASTICSEARCH_URL'] else None
+    from app.metrics import Instrumentation
+    app.instrumentation = Instrumentation(app)
+
+    from app.search import create_search_backend
+    app.search_backend = create_search_backend(app)
+
+    from app.language import create_detector
+    app.language_detector = create_detector(app.config)
+
+    from app.translate import create_translator, TranslationCache
+    app.translator = create_translator(app.config)
+    app.translation_cache = TranslationCache(app.config['TRANSLATION_CACHE_SIZE'])
+
+    from app.activity import LastSeenTracker
+    app.last_seen_tracker = LastSeenTracker(app)
+
+    from app.pubsub import create_broker
+    app.notification_broker = create_broker(app)
+
+    from app.email import MailWorkerPool
+    app.mail_pool = MailWorkerPool(app)
+
+    from app.fragments import create_fragment_cache, render_fragment
+    app.fragment_cache = create_fragment_cache(app)
+    app.add_template_global(render_fragment)
 
     from app.errors import bp as errors_bp
     app.register_blueprint(errors_bp)
@@ -45,6 +70,9 @@ def create_app(config_class=Config):
     from app.main import bp as main_bp
     app.register_blueprint(main_bp)
 
+    from app.api import bp as api_bp
+    app.register_blueprint(api_bp, url_prefix='/api')
+
     if not app.debug and not app.testing:
         if app.config['MAIL_SERVER']:
             auth = None
@@ -0,0 +1,64 @@
+import atexit
+import threading
+from datetime import datetime
+from time import time
+from sqlalchemy import bindparam
+from app import db
+from app.models import User
+
+class LastSeenTracker(object):
+    """Buffers User.last_seen updates in memory.
+
+    A request only records a new value when the stored one is older than
+    LAST_SEEN_RESOLUTION seconds, and the buffer is written with a single
+    batched UPDATE at most once every LAST_SEEN_FLUSH_INTERVAL seconds. A
+    batch that fails to write is kept for the next flush, and whatever is
+    left is written when the process exits.
+    """
+    def __init__(self, app):
+        self.app = app
+        self.logger = app.logger
+        self.resolution = app.config['LAST_SEEN_RESOLUTION']
+        self.interval = app.config['LAST_SEEN_FLUSH_INTERVAL']
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.last_flush = time()
+        if not app.testing:
+            atexit.register(self.flush_on_exit)
+
+    def touch(self, user):
+        now = datetime.utcnow()
+        if user.last_seen is None or \
+                (now - user.last_seen).total_seconds() >= self.resolution:
+            with self.lock:
+                self.pending[user.id] = now
+        if time() - self.last_flush >= self.interval:
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            batch, self.pending = self.pending, {}
+            self.last_flush = time()
+        if not batch:
+            return 0
+        users = User.__table__
+        try:
+            db.session.execute(
+                users.update().where(users.c.id == bindparam('user_id')).values(
+                    last_seen=bindparam('seen')),
+                [{'user_id': user_id, 'seen': seen} for user_id, seen in batch.items()])
+            db.session.commit()
+        except Exception:
+            # don't fail the request that happened to trigger the flush, keep
+            # the batch unless a newer value was recorded in the meantime
+            db.session.rollback()
+            self.logger.exception('Last seen update failed')
+            with self.lock:
+                for user_id, seen in batch.items():
+                    self.pending.setdefault(user_id, seen)
+            return 0
+        return len(batch)
+
+    def flush_on_exit(self):
+        with self.app.app_context():
+            self.flush()
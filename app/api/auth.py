@@ -0,0 +1,31 @@
+from functools import wraps
+from flask import jsonify, request
+from flask_login import current_user
+from app import login
+from app.api import bp
+from app.api.errors import error_response
+from app.models import User
+
+@login.request_loader
+def load_user_from_token(request):
+    # scripts send "Authorization: Bearer <token>", browsers use the session
+    header = request.headers.get('Authorization', '')
+    if request.blueprint == 'api' and header.startswith('Bearer '):
+        return User.verify_api_token(header[7:])
+
+def token_required(f):
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        if not current_user.is_authenticated:
+            return error_response(401)
+        return f(*args, **kwargs)
+    return decorated
+
+@bp.route('/tokens', methods=['POST'])
+def get_token():
+    auth = request.authorization
+    user = User.query.filter_by(username=auth.username).first() if auth else None
+    if user is None or not user.check_password(auth.password):
+        return error_response(401)
+    expires_in = 3600
+    return jsonify({'token': user.get_api_token(expires_in), 'expires_in': expires_in})
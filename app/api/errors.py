@@ -0,0 +1,27 @@
+from flask import jsonify
+from werkzeug.exceptions import HTTPException
+from werkzeug.http import HTTP_STATUS_CODES
+from app import db
+from app.api import bp
+
+def error_response(status_code, message=None):
+    payload = {'error': HTTP_STATUS_CODES.get(status_code, 'Unknown error')}
+    if message:
+        payload['message'] = message
+    response = jsonify(payload)
+    response.status_code = status_code
+    return response
+
+def bad_request(message):
+    return error_response(400, message)
+
+# the app wide 404 and 500 pages would win over a plain HTTPException handler
+@bp.errorhandler(404)
+@bp.errorhandler(HTTPException)
+def http_error(error):
+    return error_response(error.code)
+
+@bp.errorhandler(500)
+def internal_error(error):
+    db.session.rollback()
+    return error_response(500)
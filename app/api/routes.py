@@ -0,0 +1,147 @@
+from flask import current_app, jsonify, request, url_for
+from flask_login import current_user
+from app import db
+from app.api import bp
+from app.api.auth import token_required
+from app.api.errors import bad_request
+from app.models import User, Post, Message, timeline
+from app.pagination import cursor_paginate
+
+# only the columns the JSON needs are selected, no ORM objects are built
+post_columns = (Post.id, Post.body, Post.timestamp, Post.language, Post.parent_id,
+                Post.likes_count, Post.comments_count, User.username.label('author'))
+user_columns = (User.id, User.username, User.about_me, User.last_seen, User.avatar_hash,
+                User.followers_count, User.followed_count)
+message_columns = (Message.id, Message.body, Message.timestamp, User.username.label('sender'))
+
+def timestamp(value):
+    return value.isoformat() + 'Z' if value else None
+
+def post_dict(row):
+    return {'id': row.id, 'author': row.author, 'body': row.body,
+            'timestamp': timestamp(row.timestamp), 'language': row.language or None,
+            'parent_id': row.parent_id, 'likes': row.likes_count,
+            'comments': row.comments_count}
+
+def user_dict(row):
+    return {'id': row.id, 'username': row.username, 'about_me': row.about_me,
+            'last_seen': timestamp(row.last_seen), 'avatar': User.avatar_url(row.avatar_hash, 128),
+            'followers': row.followers_count, 'following': row.followed_count}
+
+def message_dict(row):
+    return {'id': row.id, 'sender': row.sender, 'body': row.body,
+            'timestamp': timestamp(row.timestamp)}
+
+def posts(query):
+    return query.join(User, User.id == Post.user_id).with_entities(*post_columns)
+
+def conditional(payload, last_modified=None):
+    # private data, so caches may keep it but must check the ETag every time
+    response = jsonify(payload)
+    response.add_etag()
+    response.last_modified = last_modified
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
+
+def page(query, columns, serialize, endpoint, key=None, descending=True,
+         last_modified=False, **kwargs):
+    per_page = max(1, min(request.args.get('per_page', current_app.config['POSTS_PER_PAGE'],
+                                           type=int), 100))
+    result = cursor_paginate(query, columns, per_page, before=request.args.get('before'),
+                             after=request.args.get('after'), key=key, descending=descending)
+    if 'per_page' in request.args:
+        kwargs['per_page'] = per_page
+    payload = {
+        'items': [serialize(row) for row in result.items],
+        '_links': {
+            'self': url_for(endpoint, **dict(request.args, **kwargs)),
+            'next': url_for(endpoint, before=result.next_cursor, **kwargs)
+                if result.has_next else None,
+            'prev': url_for(endpoint, after=result.prev_cursor, **kwargs)
+                if result.has_prev else None,
+        },
+    }
+    newest = max((row.timestamp for row in result.items), default=None) \
+        if last_modified else None
+    return conditional(payload, newest)
+
+@bp.route('/timeline')
+@token_required
+def get_timeline():
+    return page(posts(current_user.timeline_posts()), [timeline.c.timestamp, timeline.c.post_id],
+                post_dict, 'api.get_timeline', key=lambda row: (row.timestamp, row.id))
+
+@bp.route('/posts')
+@token_required
+def get_posts():
+    return page(posts(Post.query), [Post.timestamp, Post.id], post_dict, 'api.get_posts')
+
+@bp.route('/posts/<int:id>')
+@token_required
+def get_post(id):
+    return conditional(post_dict(posts(Post.query.filter(Post.id == id)).first_or_404()))
+
+@bp.route('/posts/<int:id>/comments')
+@token_required
+def get_comments(id):
+    post = db.session.query(Post.id).filter(Post.id == id).first_or_404()
+    return page(posts(Post.query.filter(Post.parent_id == post.id)), [Post.timestamp, Post.id],
+                post_dict, 'api.get_comments', id=id)
+
+@bp.route('/users/<username>')
+@token_required
+def get_user(username):
+    return conditional(user_dict(User.query.filter_by(username=username).with_entities(
+        *user_columns).first_or_404()))
+
+@bp.route('/users/<username>/posts')
+@token_required
+def get_user_posts(username):
+    user = User.query.filter_by(username=username).first_or_404()
+    return page(posts(user.get_posts()), [Post.timestamp, Post.id], post_dict,
+                'api.get_user_posts', username=username)
+
+@bp.route('/users/<username>/followers')
+@token_required
+def get_followers(username):
+    user = User.query.filter_by(username=username).first_or_404()
+    return page(user.followers.with_entities(*user_columns), [User.username, User.id],
+                user_dict, 'api.get_followers', descending=False, username=username)
+
+@bp.route('/users/<username>/following')
+@token_required
+def get_following(username):
+    user = User.query.filter_by(username=username).first_or_404()
+    return page(user.followed.with_entities(*user_columns), [User.username, User.id],
+                user_dict, 'api.get_following', descending=False, username=username)
+
+@bp.route('/following', methods=['POST', 'DELETE'])
+@token_required
+def bulk_follow():
+    # {"usernames": [...]}, POST follows them all and DELETE unfollows them
+    data = request.get_json(silent=True) or {}
+    usernames = data.get('usernames')
+    if not isinstance(usernames, list) or not all(isinstance(u, str) for u in usernames):
+        return bad_request('usernames must be a list of strings')
+    if len(usernames) > current_app.config['FOLLOW_BATCH_SIZE']:
+        return bad_request('at most {} usernames per request'.format(
+            current_app.config['FOLLOW_BATCH_SIZE']))
+    ids = dict(db.session.query(User.username, User.id).filter(User.username.in_(usernames)))
+    edges = [(current_user.id, id) for id in ids.values()]
+    if request.method == 'POST':
+        changed, key = User.add_follows(edges), 'followed'
+    else:
+        changed, key = User.remove_follows(edges), 'unfollowed'
+    db.session.commit()
+    names = {id: username for username, id in ids.items()}
+    return jsonify({key: sorted(names[b] for _, b in changed),
+                    'unknown': sorted(set(usernames) - set(ids))})
+
+@bp.route('/messages')
+@token_required
+def get_messages():
+    # messages never change once sent, so the newest one dates the page
+    query = current_user.messages_received.join(User, User.id == Message.sender_id)
+    return page(query.with_entities(*message_columns), [Message.timestamp, Message.id],
+                message_dict, 'api.get_messages', last_modified=True)
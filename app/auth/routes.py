@@ -6,6 +6,7 @@ from app.auth import bp
 from app.auth.forms import LoginForm, RegistrationForm, ResetPasswordRequestForm, ChangePasswordForm
 from app.models import User
 from app.auth.email import send_password_reset_email
+from app.email import MailQueueFull
 
 @bp.route('/register', methods=['GET', 'POST'])
 def register():
@@ -51,7 +52,11 @@ def reset_password_request():
     if form.validate_on_submit():
         user = User.query.filter_by(email=form.email.data).first()
         if user:
-            send_password_reset_email(user)
+            try:
+                send_password_reset_email(user)
+            except MailQueueFull:
+                flash('Too many requests, please try again in a few minutes')
+                return redirect(url_for('auth.reset_password_request'))
         flash('Check your email for the instructions to reset your password')
         return redirect(url_for('auth.login'))
     return render_template('auth/reset_password_request.html', title='Request Password Reset', form=form)
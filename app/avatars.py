@@ -0,0 +1,34 @@
+import os
+import httpx
+from flask import current_app
+
+signatures = {
+    b'\x89PNG': 'image/png',
+    b'\xff\xd8': 'image/jpeg',
+    b'GIF8': 'image/gif',
+}
+
+def image_type(path):
+    with open(path, 'rb') as f:
+        head = f.read(4)
+    for signature, mimetype in signatures.items():
+        if head.startswith(signature):
+            return mimetype
+    return 'application/octet-stream'
+
+def fetch_avatar(digest, size):
+    """Path of the cached Gravatar image, downloading it on first use."""
+    folder = current_app.config['AVATAR_CACHE_DIR']
+    path = os.path.join(folder, '{}_{}'.format(digest, size))
+    if not os.path.exists(path):
+        with current_app.instrumentation.timer('gravatar'):
+            response = httpx.get('https://www.gravatar.com/avatar/{}?d=identicon&s={}'.format(
+                digest, size), timeout=current_app.config['AVATAR_FETCH_TIMEOUT'])
+        response.raise_for_status()
+        os.makedirs(folder, exist_ok=True)
+        # write under a temporary name so a concurrent request never serves half a file
+        partial = '{}.{}'.format(path, os.getpid())
+        with open(partial, 'wb') as f:
+            f.write(response.content)
+        os.replace(partial, path)
+    return path
@@ -0,0 +1,204 @@
+import random
+import subprocess
+from datetime import datetime, timedelta
+from time import perf_counter
+from werkzeug.security import generate_password_hash
+from app import db
+from app.models import User, Post, Message, Notification, followers, likes
+
+WORDS = ('the quick brown fox jumps over lazy dog flask python query index cache '
+         'timeline coffee morning weekend travel music photo code release bug '
+         'database server latency review deploy garden book movie dinner').split()
+
+def _sentence(rng, length):
+    return ' '.join(rng.choice(WORDS) for _ in range(length)).capitalize()
+
+def _power_law(rng, population, weights, k):
+    # sample k distinct items, popular ones (high weight) more often
+    chosen = set()
+    while len(chosen) < k:
+        chosen.update(rng.choices(population, weights, k=k - len(chosen)))
+    return chosen
+
+def seed(users=1000, follows=20, posts=10, comments=3, likes_per_user=30,
+         messages=2, days=30, batch_size=500, random_seed=0):
+    """Fill an empty database with a synthetic but realistically shaped dataset.
+
+    Follow counts and follow targets both follow a power law, so a few users
+    have most of the followers, the way real social graphs look. Per user
+    figures are averages. Returns the number of rows created per model.
+    """
+    rng = random.Random(random_seed)
+    now = datetime.utcnow()
+    def timestamp():
+        return now - timedelta(seconds=rng.randrange(days * 86400))
+
+    password_hash = generate_password_hash('bench')
+    for first in range(0, users, batch_size):
+        db.session.add_all([
+            User(username='user{}'.format(i), email='user{}@example.com'.format(i),
+                 password_hash=password_hash, about_me=_sentence(rng, 6))
+            for i in range(first, min(first + batch_size, users))])
+        db.session.commit()
+    user_ids = [id for id, in db.session.query(User.id).order_by(User.id)]
+    popularity = [1.0 / (rank + 1) for rank in range(users)]
+    ranked = rng.sample(user_ids, users)
+
+    edges = []
+    for user_id in user_ids:
+        # Pareto with alpha 1.5 has a mean of 3 * xm
+        degree = min(users - 1, int(rng.paretovariate(1.5) * follows / 3))
+        targets = _power_law(rng, ranked, popularity, degree + 1) - {user_id}
+        edges += [{'follower_id': user_id, 'followed_id': t} for t in list(targets)[:degree]]
+    for first in range(0, len(edges), batch_size * 10):
+        db.session.execute(followers.insert(), edges[first:first + batch_size * 10])
+    User.reconcile_counters(user_ids[0], user_ids[-1])
+    db.session.commit()
+    following = {}
+    for edge in edges:
+        following.setdefault(edge['follower_id'], []).append(edge['followed_id'])
+    usernames = dict(db.session.query(User.id, User.username))
+
+    def body(user_id):
+        text = _sentence(rng, rng.randint(3, 15))
+        if following.get(user_id) and rng.random() < 0.2:
+            text += ' @' + usernames[rng.choice(following[user_id])]
+        return text
+
+    # posts go through the ORM so mentions, counters and timeline fan-out
+    # are maintained the same way as in the application
+    authors = rng.choices(ranked, popularity, k=users * posts)
+    for first in range(0, len(authors), batch_size):
+        db.session.add_all([Post(body=body(a), user_id=a, timestamp=timestamp(), language='en')
+                            for a in authors[first:first + batch_size]])
+        db.session.commit()
+    post_ids = [id for id, in db.session.query(Post.id).order_by(Post.id)]
+    post_weights = [1.0 / (rank + 1) for rank in range(len(post_ids))]
+    hot_posts = rng.sample(post_ids, len(post_ids))
+
+    parents = rng.choices(hot_posts, post_weights, k=users * comments)
+    for first in range(0, len(parents), batch_size):
+        db.session.add_all([
+            Post(body=body(a), user_id=a, parent_id=p, timestamp=timestamp(), language='en')
+            for a, p in zip(rng.choices(user_ids, k=batch_size), parents[first:first + batch_size])])
+        db.session.commit()
+
+    rows = []
+    for user_id in user_ids:
+        count = min(len(post_ids), int(rng.expovariate(1.0 / likes_per_user)))
+        rows += [{'user_id': user_id, 'post_id': p}
+                 for p in _power_law(rng, hot_posts, post_weights, count)]
+    for first in range(0, len(rows), batch_size * 10):
+        db.session.execute(likes.insert(), rows[first:first + batch_size * 10])
+    Post.reconcile_counters(post_ids[0], post_ids[-1])
+    db.session.commit()
+
+    users_by_id = {u.id: u for u in User.query}
+    for _ in range(users * messages):
+        sender, recipient = rng.sample(user_ids, 2)
+        db.session.add(Message(sender_id=sender, recipient_id=recipient,
+                               body=_sentence(rng, 8), timestamp=timestamp()))
+        users_by_id[recipient].add_unread_message(users_by_id[sender])
+    for user in users_by_id.values():
+        user.add_notification('unread_message_count', user.new_messages())
+    db.session.commit()
+
+    return {'users': users, 'follows': len(edges), 'posts': len(authors),
+            'comments': len(parents), 'likes': len(rows), 'messages': users * messages}
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[max(0, int(round(p / 100.0 * len(values))) - 1)]
+
+def routes(rng, user, users, post_ids):
+    """URLs exercised by the benchmark, for one request made as ``user``."""
+    return {
+        'index': '/index',
+        'explore': '/explore',
+        'explore_hot': '/explore?sort=hot',
+        'user': '/user/{}'.format(user.username),
+        'user_following': '/user/{}?show=following'.format(user.username),
+        'user_followers': '/user/{}?show=followers'.format(user.username),
+        'user_likes': '/user/{}?show=likes'.format(user.username),
+        'user_comments': '/user/{}?show=comments'.format(user.username),
+        'user_mentions': '/user/{}?show=mentions'.format(user.username),
+        'post_info': '/post/{}'.format(rng.choice(post_ids)),
+        'user_popup': '/user/{}/popup'.format(rng.choice(users).username),
+        'notifications': '/notifications?since=0',
+        'search': '/search?q={}'.format(rng.choice(WORDS)),
+    }
+
+def run(app, requests=50, warmup=5, only=None, random_seed=0):
+    """Request every route through the test client and summarize the timings.
+
+    Each route is requested ``warmup`` times untimed and then ``requests``
+    times, as a random seeded user. Reports latency percentiles in
+    milliseconds and SQL statements per request.
+    """
+    rng = random.Random(random_seed)
+    users = User.query.order_by(User.id).limit(1000).all()
+    post_ids = [id for id, in db.session.query(Post.id).filter(
+        Post.parent_id.is_(None)).order_by(Post.id.desc()).limit(1000)]
+    if not users or not post_ids:
+        raise ValueError('The database is empty, run "flask bench seed" first.')
+
+    statements = []
+    def count(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    samples = {}
+    client = app.test_client()
+    db.event.listen(db.engine, 'before_cursor_execute', count)
+    try:
+        for i in range(warmup + requests):
+            user = rng.choice(users)
+            with client.session_transaction() as session:
+                session['_user_id'] = str(user.id)
+                session['_fresh'] = True
+            for name, url in routes(rng, user, users, post_ids).items():
+                if only and name not in only:
+                    continue
+                del statements[:]
+                start = perf_counter()
+                # the test client reuses an active app context, which would
+                # share g and the session with the previous request
+                with app.app_context():
+                    response = client.get(url)
+                elapsed = (perf_counter() - start) * 1000
+                if i < warmup:
+                    continue
+                sample = samples.setdefault(name, {'latency': [], 'queries': [], 'errors': 0})
+                sample['latency'].append(elapsed)
+                sample['queries'].append(len(statements))
+                if response.status_code >= 400:
+                    sample['errors'] += 1
+    finally:
+        db.event.remove(db.engine, 'before_cursor_execute', count)
+
+    results = {}
+    for name, sample in samples.items():
+        latency, queries = sample['latency'], sample['queries']
+        results[name] = {
+            'requests': len(latency),
+            'errors': sample['errors'],
+            'latency_ms': {'p50': percentile(latency, 50), 'p90': percentile(latency, 90),
+                           'p99': percentile(latency, 99), 'max': max(latency),
+                           'mean': sum(latency) / len(latency)},
+            'queries': {'mean': sum(queries) / len(queries), 'max': max(queries)},
+        }
+    return {
+        'commit': _git_commit(),
+        'date': datetime.utcnow().isoformat(),
+        'database': db.engine.dialect.name,
+        'dataset': {'users': User.query.count(), 'posts': Post.query.count(),
+                    'messages': Message.query.count(),
+                    'notifications': Notification.query.count()},
+        'routes': results,
+    }
+
+def _git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
@@ -0,0 +1,183 @@
+import json
+import click
+from app import db
+from app.models import User, Post
+from app.language import detect_pending, run_worker
+from app import bench as benchmark
+from app.graph import read_edges, import_follows
+from app.suggestions import update_stale
+
+def register(app):
+    @app.cli.group()
+    def timeline():
+        """Home timeline maintenance commands."""
+        pass
+
+    @timeline.command()
+    @click.option('--user', 'usernames', multiple=True,
+                  help='Only rebuild the timeline of this user (repeatable).')
+    def rebuild(usernames):
+        """Rebuild materialized home timelines from the follow graph."""
+        user_ids = None
+        if usernames:
+            user_ids = [u.id for u in User.query.filter(User.username.in_(usernames))]
+        User.rebuild_timelines(user_ids)
+        db.session.commit()
+        click.echo('Rebuilt {} timelines.'.format(
+            'all' if user_ids is None else len(user_ids)))
+
+    @app.cli.group()
+    def graph():
+        """Follow graph commands."""
+        pass
+
+    @graph.command('import')
+    @click.argument('edges', type=click.File('r'))
+    @click.option('--format', 'format', type=click.Choice(['csv', 'ndjson']),
+                  help='Edge list format, by default guessed from the file name.')
+    @click.option('--batch-size', default=None, type=int,
+                  help='Edges inserted per commit, FOLLOW_BATCH_SIZE by default.')
+    def import_(edges, format, batch_size):
+        """Add the follows in a CSV or NDJSON list of username pairs."""
+        if format is None:
+            format = 'ndjson' if edges.name.endswith(('.ndjson', '.jsonl')) else 'csv'
+        stats = None
+        try:
+            for i, stats in enumerate(import_follows(
+                    read_edges(edges, format),
+                    batch_size or app.config['FOLLOW_BATCH_SIZE']), 1):
+                if i % 10 == 0:
+                    click.echo('{edges} edges, {rate:.0f}/s'.format(**stats), err=True)
+        except ValueError as e:
+            raise click.ClickException(str(e))
+        if stats is None:
+            raise click.ClickException('The edge list is empty.')
+        click.echo('Imported {edges} edges in {seconds:.1f}s ({rate:.0f}/s): '
+                   '{followed} new, {existing} already present, '
+                   '{unknown} with unknown users.'.format(**stats))
+
+    @app.cli.group()
+    def suggestions():
+        """Follow suggestion commands."""
+        pass
+
+    @suggestions.command()
+    @click.option('--all', 'everyone', is_flag=True,
+                  help='Recompute every user, not only those whose follows or likes changed.')
+    @click.option('--batch-size', default=500, help='Users recomputed per commit.')
+    def update(everyone, batch_size):
+        """Recompute the follow suggestions of stale users."""
+        if everyone:
+            db.session.execute(db.update(User).values(suggestions_stale=True))
+            db.session.commit()
+        users = rows = 0
+        for users, rows in update_stale(batch_size, app.config['SUGGESTIONS_PER_USER'],
+                                        app.config['SUGGESTION_LIKE_WEIGHT']):
+            pass
+        click.echo('Wrote {} suggestions for {} users.'.format(rows, users))
+
+    @app.cli.group()
+    def mentions():
+        """Post mention commands."""
+        pass
+
+    @mentions.command('backfill')
+    @click.option('--batch-size', default=500, help='Posts resolved per commit.')
+    def backfill_mentions(batch_size):
+        """Resolve mentions for posts written before they were stored."""
+        total = 0
+        while True:
+            posts = Post.query.filter(Post.body_segments.is_(None)).order_by(
+                Post.id).limit(batch_size).all()
+            if not posts:
+                break
+            Post.resolve_mentions(posts)
+            db.session.commit()
+            total += len(posts)
+        click.echo('Resolved mentions for {} posts.'.format(total))
+
+    @app.cli.group()
+    def counters():
+        """Denormalized counter commands."""
+        pass
+
+    @counters.command()
+    @click.option('--batch-size', default=1000, help='Rows recounted per commit.')
+    def reconcile(batch_size):
+        """Recount follower, like and comment counters that have drifted."""
+        for model in (User, Post):
+            last_id = db.session.query(db.func.max(model.id)).scalar() or 0
+            repaired = 0
+            for first_id in range(1, last_id + 1, batch_size):
+                repaired += model.reconcile_counters(first_id, first_id + batch_size - 1)
+                db.session.commit()
+            click.echo('Repaired {} {} rows.'.format(repaired, model.__tablename__))
+
+    @app.cli.group()
+    def language():
+        """Post language detection commands."""
+        pass
+
+    @language.command('backfill')
+    @click.option('--batch-size', default=50, help='Posts sent to the detector at once.')
+    def backfill_languages(batch_size):
+        """Detect the language of every post that does not have one yet."""
+        total = 0
+        while True:
+            try:
+                count = detect_pending(batch_size)
+            except Exception:
+                db.session.rollback()
+                app.logger.exception('Language backfill failed')
+                click.echo('Stopped after an error, run the command again to resume.')
+                break
+            total += count
+            if count < batch_size:
+                break
+        click.echo('Detected the language of {} posts.'.format(total))
+
+    @language.command()
+    def worker():
+        """Keep detecting the language of new posts, run it in one process."""
+        run_worker(app.config['LANGUAGE_DETECTION_BATCH_SIZE'],
+                   app.config['LANGUAGE_DETECTION_INTERVAL'])
+
+    @app.cli.group()
+    def bench():
+        """Synthetic dataset and route benchmark commands."""
+        pass
+
+    @bench.command()
+    @click.option('--users', default=1000, help='Number of users.')
+    @click.option('--follows', default=20, help='Average users followed per user.')
+    @click.option('--posts', default=10, help='Average posts per user.')
+    @click.option('--comments', default=3, help='Average comments per user.')
+    @click.option('--likes', default=30, help='Average likes per user.')
+    @click.option('--messages', default=2, help='Average messages per user.')
+    @click.option('--seed', 'random_seed', default=0, help='Random seed.')
+    def seed(users, follows, posts, comments, likes, messages, random_seed):
+        """Fill an empty database with synthetic users, posts and activity."""
+        if User.query.first() is not None:
+            raise click.ClickException('The database already has users.')
+        created = benchmark.seed(users=users, follows=follows, posts=posts,
+                                 comments=comments, likes_per_user=likes,
+                                 messages=messages, random_seed=random_seed)
+        click.echo(', '.join('{} {}'.format(n, name) for name, n in created.items()))
+
+    @bench.command()
+    @click.option('--requests', default=50, help='Timed requests per route.')
+    @click.option('--warmup', default=5, help='Untimed requests per route.')
+    @click.option('--route', 'only', multiple=True,
+                  help='Only benchmark this route (repeatable).')
+    @click.option('--output', type=click.File('w'), default='-',
+                  help='File the JSON results are written to.')
+    @click.option('--seed', 'random_seed', default=0, help='Random seed.')
+    def run(requests, warmup, only, output, random_seed):
+        """Time the main routes and report latency and query counts as JSON."""
+        try:
+            results = benchmark.run(app, requests=requests, warmup=warmup,
+                                    only=only, random_seed=random_seed)
+        except ValueError as e:
+            raise click.ClickException(str(e))
+        json.dump(results, output, indent=2)
+        output.write('\n')
@@ -0,0 +1,73 @@
+from time import time
+from flask import has_request_context, request, session
+from flask_sqlalchemy.session import Session
+from sqlalchemy import event
+from sqlalchemy.engine import make_url
+
+class RoutingSession(Session):
+    """Sends the reads of GET requests to the 'replica' bind when there is one.
+
+    Writes, flushes and every statement after the first write go to the
+    primary. A client that wrote something keeps reading from the primary for
+    DATABASE_REPLICA_STICKY seconds, so it sees its own changes even while the
+    replica lags behind.
+    """
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and 'replica' in self._db.engines:
+            if self._flushing or getattr(clause, 'is_dml', False):
+                self.info['wrote'] = True
+            elif not self.info.get('wrote') and use_replica():
+                return self._db.engines['replica']
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+def use_replica():
+    return has_request_context() and request.method in ('GET', 'HEAD') and \
+        session.get('read_primary_until', 0) < time()
+
+def engine_options(config, url):
+    if make_url(url).get_backend_name() == 'sqlite':
+        # pooling options don't apply to SQLite's NullPool/StaticPool
+        return {}
+    return {
+        'pool_size': config['DATABASE_POOL_SIZE'],
+        'max_overflow': config['DATABASE_MAX_OVERFLOW'],
+        'pool_recycle': config['DATABASE_POOL_RECYCLE'],
+        'pool_pre_ping': config['DATABASE_POOL_PRE_PING'],
+    }
+
+def configure_engines(app):
+    """Fill in the engine options and the replica bind before db.init_app()."""
+    config = app.config
+    config.setdefault('SQLALCHEMY_ENGINE_OPTIONS', engine_options(
+        config, config['SQLALCHEMY_DATABASE_URI']))
+    if config['DATABASE_REPLICA_URL']:
+        binds = dict(config.get('SQLALCHEMY_BINDS') or {})
+        binds['replica'] = dict(engine_options(config, config['DATABASE_REPLICA_URL']),
+                                url=config['DATABASE_REPLICA_URL'])
+        config['SQLALCHEMY_BINDS'] = binds
+
+def init_engines(app, db):
+    """Set SQLite pragmas on new connections and remember which clients wrote."""
+    pragmas = [
+        'PRAGMA journal_mode={}'.format(app.config['SQLITE_JOURNAL_MODE']),
+        'PRAGMA synchronous={}'.format(app.config['SQLITE_SYNCHRONOUS']),
+        'PRAGMA busy_timeout={:d}'.format(app.config['SQLITE_BUSY_TIMEOUT']),
+    ]
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for pragma in pragmas:
+            cursor.execute(pragma)
+        cursor.close()
+
+    with app.app_context():
+        engines = db.engines
+        for engine in engines.values():
+            if engine.dialect.name == 'sqlite':
+                event.listen(engine, 'connect', set_pragmas)
+
+    if 'replica' in engines:
+        @app.after_request
+        def stick_to_primary(response):
+            if db.session.info.get('wrote'):
+                session['read_primary_until'] = time() + app.config['DATABASE_REPLICA_STICKY']
+            return response
@@ -1,8 +1,89 @@
-from threading import Thread
+import atexit
+import queue
+import threading
+from time import time, sleep
 from flask import current_app
 from flask_mail import Message
 from app import mail
 
+class MailQueueFull(Exception):
+    pass
+
+class MailWorkerPool(object):
+    """Fixed set of threads sending queued messages.
+
+    Each worker keeps its SMTP connection open while messages keep arriving
+    and closes it after MAIL_IDLE_TIMEOUT seconds without work. When all
+    MAIL_QUEUE_SIZE slots are taken, submit() waits MAIL_QUEUE_TIMEOUT seconds
+    for one to free up and then raises MailQueueFull.
+    """
+    def __init__(self, app):
+        self.app = app
+        self.logger = app.logger
+        self.workers = app.config['MAIL_WORKERS']
+        self.idle_timeout = app.config['MAIL_IDLE_TIMEOUT']
+        self.put_timeout = app.config['MAIL_QUEUE_TIMEOUT']
+        self.queue = queue.Queue(app.config['MAIL_QUEUE_SIZE'])
+        self.lock = threading.Lock()
+        self.threads = []
+        self.stats = {'sent': 0, 'failed': 0, 'rejected': 0, 'send_seconds': 0.0}
+
+    def start(self):
+        with self.lock:
+            if self.threads:
+                return
+            for _ in range(self.workers):
+                thread = threading.Thread(target=self.run, daemon=True)
+                thread.start()
+                self.threads.append(thread)
+        atexit.register(self.drain)
+
+    def submit(self, msg):
+        self.start()
+        try:
+            self.queue.put(msg, timeout=self.put_timeout)
+        except queue.Full:
+            self.count('rejected')
+            raise MailQueueFull()
+
+    def count(self, stat, n=1):
+        with self.lock:
+            self.stats[stat] += n
+
+    def metrics(self):
+        with self.lock:
+            return dict(self.stats, queue_depth=self.queue.qsize(),
+                        queue_size=self.queue.maxsize)
+
+    def run(self):
+        with self.app.app_context():
+            while True:
+                msg = self.queue.get()
+                try:
+                    with mail.connect() as conn:
+                        while msg is not None:
+                            start = time()
+                            with self.app.instrumentation.timer('smtp'):
+                                conn.send(msg)
+                            self.count('send_seconds', time() - start)
+                            self.count('sent')
+                            self.queue.task_done()
+                            try:
+                                msg = self.queue.get(timeout=self.idle_timeout)
+                            except queue.Empty:
+                                msg = None
+                except Exception:
+                    # drop the message and reconnect for the next one
+                    if msg is not None:
+                        self.count('failed')
+                        self.queue.task_done()
+                    self.logger.exception('Sending email failed')
+
+    def drain(self, timeout=10):
+        deadline = time() + timeout
+        while self.queue.unfinished_tasks and time() < deadline:
+            sleep(0.1)
+
 def send_email(subject, sender, recipients, text_body, html_body,
                attachments=None, sync=False):
     msg = Message(subject, sender=sender, recipients=recipients)
@@ -14,8 +95,4 @@ def send_email(subject, sender, recipients, text_body, html_body,
     if sync:
         mail.send(msg)
     else:
-        Thread(target=send_async_email, args=(current_app._get_current_object(), msg)).start()
-
-def send_async_email(app, msg):
-    with app.app_context():
-        mail.send(msg)
\ No newline at end of file
+        current_app.mail_pool.submit(msg)
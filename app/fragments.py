@@ -0,0 +1,98 @@
+import threading
+from collections import OrderedDict
+from flask import current_app, g, render_template
+from flask_login import current_user
+from markupsafe import Markup
+
+class MemoryStore(object):
+    """Per-process LRU of rendered fragments."""
+    def __init__(self, app):
+        self.size = app.config['FRAGMENT_CACHE_SIZE']
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            html = self.entries.get(key)
+            if html is not None:
+                self.entries.move_to_end(key)
+            return html
+
+    def put(self, key, html):
+        with self.lock:
+            self.entries[key] = html
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+class RedisStore(object):
+    """Fragments shared by all workers, expired after FRAGMENT_CACHE_TIMEOUT."""
+    def __init__(self, app):
+        import redis
+        self.redis = redis.Redis.from_url(app.config['REDIS_URL'])
+        self.timeout = app.config['FRAGMENT_CACHE_TIMEOUT']
+
+    def get(self, key):
+        html = self.redis.get('fragment:' + key)
+        return html.decode('utf-8') if html is not None else None
+
+    def put(self, key, html):
+        self.redis.setex('fragment:' + key, self.timeout, html)
+
+stores = {
+    'memory': MemoryStore,
+    'redis': RedisStore,
+}
+
+class FragmentCache(object):
+    """Rendered template fragments, keyed by what they were rendered from.
+
+    Keys carry the version of every row a fragment shows, so edits never
+    need to delete anything: the next render simply misses.
+    """
+    def __init__(self, store):
+        self.store = store
+        self.stats = {'hits': 0, 'misses': 0}
+
+    def render(self, template, key, **context):
+        if self.store is None:
+            return Markup(render_template(template, **context))
+        html = self.store.get(key)
+        if html is None:
+            self.stats['misses'] += 1
+            html = render_template(template, **context)
+            self.store.put(key, html)
+        else:
+            self.stats['hits'] += 1
+        return Markup(html)
+
+def create_fragment_cache(app):
+    name = app.config['FRAGMENT_CACHE']
+    return FragmentCache(stores[name](app) if name else None)
+
+def post_key(post, no_margin=None):
+    users = [post.author] + list(post.mentions)
+    if post.parent_id is not None:
+        users.append(post.parent.author)
+    return ['post', post.id, post.version, post.language, post.likes_count,
+            g.viewer.liked(post), bool(no_margin)] + \
+        ['{}.{}'.format(user.id, user.version) for user in users]
+
+def user_key(user):
+    return ['user', user.id, user.version, user == current_user, g.viewer.following(user)]
+
+def message_key(message):
+    return ['message', message.id, message.sender.id, message.sender.version]
+
+fragments = {
+    'post': ('comp/_post_fragment.html', post_key),
+    'user': ('comp/_user_fragment.html', user_key),
+    'message': ('comp/_message_fragment.html', message_key),
+}
+
+def render_fragment(kind, obj, **context):
+    template, key = fragments[kind]
+    parts = key(obj, **context) + [g.locale]
+    context[kind] = obj
+    return current_app.fragment_cache.render(
+        template, ':'.join(str(part) for part in parts), **context)
@@ -0,0 +1,51 @@
+import csv
+import json
+from itertools import islice
+from time import perf_counter
+from app import db
+from app.models import User
+
+def read_edges(file, format):
+    """Yield (follower, followed) username pairs from an edge list.
+
+    CSV files need a header row with "follower" and "followed" columns,
+    NDJSON files have one {"follower": ..., "followed": ...} object per line.
+    """
+    if format == 'csv':
+        rows = csv.DictReader(file)
+        if not rows.fieldnames or not {'follower', 'followed'} <= set(rows.fieldnames):
+            raise ValueError('The CSV header needs "follower" and "followed" columns.')
+    else:
+        rows = (json.loads(line) for line in file if line.strip())
+    for n, row in enumerate(rows, 1):
+        try:
+            yield row['follower'].strip(), row['followed'].strip()
+        except (KeyError, TypeError, AttributeError):
+            raise ValueError('Edge {} is missing a follower or a followed user.'.format(n))
+
+def import_follows(edges, batch_size=1000):
+    """Add follows from (follower, followed) username pairs, one commit per batch.
+
+    Edges that exist already are left alone and edges naming unknown users are
+    skipped. Yields the running totals after each batch, with the elapsed
+    time and the edges processed per second.
+    """
+    stats = {'edges': 0, 'followed': 0, 'existing': 0, 'unknown': 0}
+    start = perf_counter()
+    edges = iter(edges)
+    while True:
+        batch = list(islice(edges, batch_size))
+        if not batch:
+            break
+        names = {name for edge in batch for name in edge}
+        ids = dict(db.session.query(User.username, User.id).filter(User.username.in_(names)))
+        pairs = [(ids[a], ids[b]) for a, b in batch if a in ids and b in ids]
+        new = User.add_follows(pairs)
+        db.session.commit()
+        stats['edges'] += len(batch)
+        stats['followed'] += len(new)
+        stats['existing'] += len(pairs) - len(new)
+        stats['unknown'] += len(batch) - len(pairs)
+        stats['seconds'] = perf_counter() - start
+        stats['rate'] = stats['edges'] / stats['seconds'] if stats['seconds'] else 0.0
+        yield stats
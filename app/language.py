@@ -0,0 +1,81 @@
+import time
+from flask import current_app
+from googletrans import Translator
+from app import db
+from app.models import Post
+
+class GoogleDetector(object):
+    def detect(self, texts):
+        detected = Translator().detect(texts)
+        languages = []
+        for d in detected:
+            # ambiguous text comes back with a list of candidates
+            lang = d.lang[0] if isinstance(d.lang, list) else d.lang
+            languages.append(lang[:5] if lang else '')
+        return languages
+
+class StaticDetector(object):
+    """Offline stand-in that tags every text with the same language."""
+    def __init__(self, language='en'):
+        self.language = language
+
+    def detect(self, texts):
+        return [self.language for _ in texts]
+
+detectors = {
+    'google': GoogleDetector,
+    'static': StaticDetector,
+}
+
+def create_detector(config):
+    return detectors[config['LANGUAGE_DETECTOR']]()
+
+def detect(texts):
+    try:
+        with current_app.instrumentation.timer('detect'):
+            languages = current_app.language_detector.detect(texts)
+        if len(languages) != len(texts):
+            raise ValueError('Expected {} languages, got {}'.format(len(texts), len(languages)))
+        return languages
+    except Exception:
+        if len(texts) == 1:
+            current_app.logger.exception('Language detection failed')
+            return ['']
+    # find the texts the detector fails on by trying them one at a time
+    current_app.logger.warning('Language detection failed for a batch of %d posts',
+                               len(texts))
+    return [detect([text])[0] for text in texts]
+
+def detect_pending(batch_size):
+    """Detect the language of one batch of posts saved without one.
+
+    Returns the number of posts processed. Posts the detector has nothing to
+    say about, or fails on, get an empty language so they are not picked up
+    again and can't hold up the posts behind them.
+    """
+    posts = db.session.query(Post.id, Post.body).filter(
+        Post.language.is_(None)).order_by(Post.id).limit(batch_size).all()
+    if not posts:
+        return 0
+    languages = detect([p.body or '' for p in posts])
+    db.session.bulk_update_mappings(Post, [
+        {'id': p.id, 'language': lang or ''} for p, lang in zip(posts, languages)])
+    db.session.commit()
+    return len(posts)
+
+def run_worker(batch_size, interval):
+    """Detect the language of new posts until interrupted.
+
+    Runs in a single dedicated process (``flask language worker``) so that
+    web workers and other commands never race on the same posts. Pending
+    posts are picked up every ``interval`` seconds.
+    """
+    while True:
+        try:
+            while detect_pending(batch_size) == batch_size:
+                pass
+        except Exception:
+            # leave the batch for the next round
+            db.session.rollback()
+            current_app.logger.exception('Language detection failed')
+        time.sleep(interval)
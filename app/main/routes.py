@@ -1,20 +1,27 @@
-from datetime import datetime
-from flask import render_template, flash, redirect, url_for, request, g, jsonify, current_app
+import hashlib
+import json
+import re
+from time import time
+from flask import render_template, flash, redirect, url_for, request, g, jsonify, current_app, \
+    Response, stream_with_context, abort, send_file, make_response
 from flask_login import current_user, login_required
 from flask_babel import get_locale
 from app import db
 from app.main.forms import EditProfileForm, PostForm, CommentForm, SearchForm, MessageForm, EmptyForm
-from app.models import User, Post, Message, Notification
-from googletrans import Translator
+from app.models import User, Post, Message, Notification, timeline, likes
+from app.pagination import cursor_paginate
+from app.translate import translate
+from app.viewer import ViewerState
+from app.avatars import fetch_avatar, image_type
 from app.main import bp
 
 @bp.before_request
 def before_request():
     if current_user.is_authenticated:
-        current_user.last_seen = datetime.utcnow()
-        db.session.commit()
+        current_app.last_seen_tracker.touch(current_user)
         g.search_form = SearchForm()
     g.locale = str(get_locale())
+    g.viewer = ViewerState(current_user)
 
 @bp.route('/', methods=['GET', 'POST'])
 @bp.route('/index', methods=['GET', 'POST'])
@@ -22,49 +29,57 @@ def before_request():
 def index():
     form = PostForm()
     if form.validate_on_submit():
-        language = Translator().detect(form.post.data).lang
-        post = Post(body=form.post.data, author=current_user, language=language)
+        post = Post(body=form.post.data, author=current_user)
         db.session.add(post)
         db.session.commit()
         flash('Your post is now live!')
         return redirect(url_for('main.index'))
-    page = request.args.get('page', 1, type=int)
-    posts = current_user.followed_posts().paginate(
-        page=page, per_page=current_app.config['POSTS_PER_PAGE'], error_out=False)
-    next_url = url_for('main.index', page=posts.next_num) \
+    posts = cursor_paginate(
+        Post.with_relations(current_user.timeline_posts()), [timeline.c.timestamp, timeline.c.post_id],
+        current_app.config['POSTS_PER_PAGE'], before=request.args.get('before'),
+        after=request.args.get('after'), key=lambda post: (post.timestamp, post.id))
+    g.viewer.load(posts=posts.items)
+    next_url = url_for('main.index', before=posts.next_cursor) \
         if posts.has_next else None
-    prev_url = url_for('main.index', page=posts.prev_num) \
+    prev_url = url_for('main.index', after=posts.prev_cursor) \
         if posts.has_prev else None
+    suggestions = current_user.suggested_users(current_app.config['SUGGESTIONS_SHOWN']).all()
     return render_template('index.html', title='Home', form=form,
-                           posts=posts.items, next_url=next_url, prev_url=prev_url)
+                           posts=posts.items, next_url=next_url, prev_url=prev_url,
+                           suggestions=suggestions, follow_form=EmptyForm())
 
 @bp.route('/explore')
 @login_required
 def explore():
-    page = request.args.get('page', 1, type=int)
-    posts = Post.query.order_by(Post.timestamp.desc()).paginate(
-        page=page, per_page=current_app.config['POSTS_PER_PAGE'], error_out=False)
-    next_url = url_for('main.explore', page=posts.next_num) \
+    # sort=hot reads ix_post_hot_score, kept up to date on likes and comments
+    sort = 'hot' if request.args.get('sort') == 'hot' else None
+    columns = [Post.hot_score, Post.id] if sort else [Post.timestamp, Post.id]
+    posts = cursor_paginate(
+        Post.with_relations(Post.query), columns,
+        current_app.config['POSTS_PER_PAGE'], before=request.args.get('before'),
+        after=request.args.get('after'))
+    g.viewer.load(posts=posts.items)
+    next_url = url_for('main.explore', sort=sort, before=posts.next_cursor) \
         if posts.has_next else None
-    prev_url = url_for('main.explore', page=posts.prev_num) \
+    prev_url = url_for('main.explore', sort=sort, after=posts.prev_cursor) \
         if posts.has_prev else None
     return render_template('index.html', title='Explore', posts=posts.items,
-                           next_url=next_url, prev_url=prev_url)
+                           next_url=next_url, prev_url=prev_url, sort=sort or 'latest')
 
 @bp.route('/user/<username>')
 @login_required
 def user(username):
     user = User.query.filter_by(username=username).first_or_404()
-    page = request.args.get('page', 1, type=int)
     show = request.args.get('show')
 
     if show is not None and current_user.username != username:
         return redirect(url_for('main.user', username=user.username))
 
     if show in [None, 'following', 'followers', 'likes', 'comments', 'mentions']:
+        columns = [Post.timestamp, Post.id]
+        descending = True
         if show is None:
-            items = user.get_posts().order_by(Post.timestamp.desc()).paginate(
-                page=page, per_page=current_app.config['POSTS_PER_PAGE'], error_out=False)
+            items = Post.with_relations(user.get_posts())
             if current_user.username != username:
                 title = user.username + "'s Profile"
             else :
@@ -72,33 +87,45 @@ def user(username):
             pag_text = ('Older posts', 'Newer posts')
             id = 1
         elif show == 'following':
-            items = user.followed.order_by(User.username.asc()).paginate(
-                page=page, per_page=current_app.config['POSTS_PER_PAGE'], error_out=False)
+            items = user.followed
+            columns = [User.username, User.id]
+            descending = False
             title = 'Who You Follow'
             pag_text = ('Previous Page', 'Next Page')
             id = 2
         elif show == 'followers':
-            items = user.followers.order_by(User.username.asc()).paginate(
-                page=page, per_page=current_app.config['POSTS_PER_PAGE'], error_out=False)
+            items = user.followers
+            columns = [User.username, User.id]
+            descending = False
             title = 'Who Follows You'
             pag_text = ('Previous Page', 'Next Page')
             id = 3
         elif show == 'likes':
-            items = user.liked_posts.order_by(Post.timestamp.desc()).paginate(
-                page=page, per_page=current_app.config['POSTS_PER_PAGE'], error_out=False)
+            items = Post.with_relations(user.liked_posts)
             title = 'Posts You Like'
             pag_text = ('Older posts', 'Newer posts')
             id = 4
+        elif show == 'mentions':
+            items = Post.with_relations(user.mentioned_in)
+            title = 'Posts That Mention You'
+            pag_text = ('Older posts', 'Newer posts')
+            id = 6
         else:
-            items = user.get_comments().order_by(Post.timestamp.desc()).paginate(
-                page=page, per_page=current_app.config['POSTS_PER_PAGE'], error_out=False)
+            items = Post.with_relations(user.get_comments())
             title = 'Your Comments'
             pag_text = ('Older comments', 'Newer comments')
             id = 5
+        items = cursor_paginate(
+            items, columns, current_app.config['POSTS_PER_PAGE'], descending=descending,
+            before=request.args.get('before'), after=request.args.get('after'))
+        if show in ['following', 'followers']:
+            g.viewer.load(users=items.items + [user])
+        else:
+            g.viewer.load(posts=items.items, users=[user])
 
-        next_url = url_for('main.user', username=user.username, show=show, page=items.next_num) \
+        next_url = url_for('main.user', username=user.username, show=show, before=items.next_cursor) \
             if items.has_next else None
-        prev_url = url_for('main.user', username=user.username, show=show, page=items.prev_num) \
+        prev_url = url_for('main.user', username=user.username, show=show, after=items.prev_cursor) \
             if items.has_prev else None
 
         form = EmptyForm()
@@ -108,11 +135,37 @@ def user(username):
     else:
         return redirect(url_for('main.user', username=user.username))
 
+def popup(key, render):
+    # the ETag comes from the versions and counters the popup shows, so a
+    # matching If-None-Match gets a 304 without rendering the template
+    etag = hashlib.md5(json.dumps(key, default=str).encode()).hexdigest()
+    if etag in request.if_none_match:
+        response = current_app.response_class(status=304)
+    else:
+        response = make_response(render())
+    response.set_etag(etag)
+    response.cache_control.private = True
+    response.cache_control.max_age = current_app.config['POPUP_MAX_AGE']
+    return response
+
 @bp.route('/user/<username>/popup')
 @login_required
 def user_popup(username):
     user = User.query.filter_by(username=username).first_or_404()
-    return render_template('user_popup.html', user=user)
+    return popup(['user', user.id, user.version, user.followers_count, user.followed_count,
+                  user.last_seen], lambda: render_template('user_popup.html', user=user))
+
+@bp.route('/avatar/<digest>/<int:size>')
+def avatar(digest, size):
+    if not re.fullmatch('[0-9a-f]{32}', digest) or not 1 <= size <= 512:
+        abort(404)
+    try:
+        path = fetch_avatar(digest, size)
+    except Exception:
+        current_app.logger.exception('Avatar fetch failed')
+        return redirect('https://www.gravatar.com/avatar/{}?d=identicon&s={}'.format(digest, size))
+    return send_file(path, mimetype=image_type(path),
+                     max_age=current_app.config['AVATAR_MAX_AGE'])
 
 @bp.route('/edit_profile', methods=['GET', 'POST'])
 @login_required
@@ -172,23 +225,24 @@ def unfollow(username):
 @bp.route('/post/<post_id>', methods=['GET', 'POST'])
 @login_required
 def post_info(post_id):
-    page = request.args.get('page', 1, type=int)
-    post = Post.query.filter_by(id=post_id).first_or_404()
+    post = Post.with_relations(Post.query).filter_by(id=post_id).first_or_404()
     emp_form = EmptyForm()
     form = CommentForm()
     if form.validate_on_submit():
-        language = Translator().detect(form.comment.data).lang
-        comment = Post(body=form.comment.data, author=current_user, language=language, parent_id=post_id)
+        comment = Post(body=form.comment.data, author=current_user, parent_id=post_id)
         db.session.add(comment)
         db.session.commit()
         flash('Your comment is now live!')
         return redirect(url_for('main.post_info', post_id=post_id))
 
-    comments = post.comments.order_by(Post.timestamp.desc()).paginate(
-        page=page, per_page=current_app.config['POSTS_PER_PAGE'], error_out=False)
-    next_url = url_for('main.post_info', post_id=post_id, page=comments.next_num) \
+    comments = cursor_paginate(
+        Post.with_relations(post.comments), [Post.timestamp, Post.id],
+        current_app.config['POSTS_PER_PAGE'], before=request.args.get('before'),
+        after=request.args.get('after'))
+    g.viewer.load(posts=comments.items + [post])
+    next_url = url_for('main.post_info', post_id=post_id, before=comments.next_cursor) \
         if comments.has_next else None
-    prev_url = url_for('main.post_info', post_id=post_id, page=comments.prev_num) \
+    prev_url = url_for('main.post_info', post_id=post_id, after=comments.prev_cursor) \
         if comments.has_prev else None
     return render_template('post_info.html', title=post.author.username + "'s Post", post=post,
                            form=form, emp_form=emp_form, comments=comments.items,
@@ -226,7 +280,12 @@ def unlike_post(post_id):
 @login_required
 def post_likes_popup(post_id):
     post = Post.query.filter_by(id=post_id).first_or_404()
-    return render_template('post_likes_popup.html', users=post.likes_on_post)
+    users = post.likes_on_post.order_by(likes.c.user_id).limit(
+        current_app.config['LIKES_POPUP_USERS']).all()
+    return popup(['likes', post.id, post.likes_count] +
+                 ['{}.{}'.format(user.id, user.version) for user in users],
+                 lambda: render_template('post_likes_popup.html', users=users,
+                                         more=post.likes_count - len(users)))
 
 @bp.route('/send_message/<recipient>', methods=['GET', 'POST'])
 @login_required
@@ -236,6 +295,7 @@ def send_message(recipient):
     if form.validate_on_submit():
         msg = Message(sender=current_user, recipient=user, body=form.message.data)
         db.session.add(msg)
+        user.add_unread_message(current_user)
         user.add_notification('unread_message_count', user.new_messages())
         db.session.commit()
         flash('Your message has been sent.')
@@ -246,16 +306,17 @@ def send_message(recipient):
 @bp.route('/messages')
 @login_required
 def messages():
-    current_user.last_message_read_time = datetime.utcnow()
-    current_user.add_notification('unread_message_count', 0)
-    db.session.commit()
-    page = request.args.get('page', 1, type=int)
-    messages = current_user.messages_received.order_by(
-        Message.timestamp.desc()).paginate(
-        page=page, per_page=current_app.config['POSTS_PER_PAGE'], error_out=False)
-    next_url = url_for('main.messages', page=messages.next_num) \
+    if current_user.new_messages():
+        current_user.mark_messages_read()
+        current_user.add_notification('unread_message_count', 0)
+        db.session.commit()
+    messages = cursor_paginate(
+        Message.with_relations(current_user.messages_received), [Message.timestamp, Message.id],
+        current_app.config['POSTS_PER_PAGE'], before=request.args.get('before'),
+        after=request.args.get('after'))
+    next_url = url_for('main.messages', before=messages.next_cursor) \
         if messages.has_next else None
-    prev_url = url_for('main.messages', page=messages.prev_num) \
+    prev_url = url_for('main.messages', after=messages.prev_cursor) \
         if messages.has_prev else None
     return render_template('messages.html', title='Your Messages', messages=messages.items,
                            next_url=next_url, prev_url=prev_url)
@@ -264,14 +325,54 @@ def messages():
 @login_required
 def notifications():
     since = request.args.get('since', 0.0, type=float)
-    notifications = current_user.notifications.filter(
-        Notification.timestamp > since).order_by(Notification.timestamp.asc())
+    user_id = current_user.id
+    # wait=1 is the long-poll fallback for clients without EventSource
+    subscription = current_app.notification_broker.subscribe(user_id) \
+        if request.args.get('wait', type=int) else None
+    try:
+        notifications = Notification.since(user_id, since).all()
+        if not notifications and subscription:
+            db.session.rollback()
+            subscription.wait(current_app.config['NOTIFICATION_KEEPALIVE'])
+            notifications = Notification.since(user_id, since).all()
+    finally:
+        if subscription:
+            subscription.close()
     return jsonify([{
         'name': n.name,
         'data': n.get_data(),
         'timestamp': n.timestamp
     } for n in notifications])
 
+@bp.route('/notifications/stream')
+@login_required
+def notification_stream():
+    since = request.headers.get('Last-Event-ID', type=float) or \
+        request.args.get('since', 0.0, type=float)
+    user_id = current_user.id
+    keepalive = current_app.config['NOTIFICATION_KEEPALIVE']
+    deadline = time() + current_app.config['NOTIFICATION_STREAM_TIMEOUT']
+    broker = current_app.notification_broker
+
+    def stream(since):
+        subscription = broker.subscribe(user_id)
+        try:
+            yield 'retry: 5000\n\n'
+            while time() < deadline:
+                for n in Notification.since(user_id, since):
+                    since = n.timestamp
+                    yield 'id: {}\ndata: {}\n\n'.format(n.timestamp, json.dumps({
+                        'name': n.name, 'data': n.get_data(), 'timestamp': n.timestamp}))
+                # end the read transaction so the next query sees new rows
+                db.session.rollback()
+                if not subscription.wait(keepalive):
+                    yield ': keepalive\n\n'
+        finally:
+            subscription.close()
+
+    return Response(stream_with_context(stream(since)), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
 @bp.route('/search')
 @login_required
 def search():
@@ -284,14 +385,60 @@ def search():
         if total > page * current_app.config['POSTS_PER_PAGE'] else None
     prev_url = url_for('main.search', q=g.search_form.q.data, page=page - 1) \
         if page > 1 else None
-    return render_template('search.html', title='Search Results', posts=posts.all(),
+    posts = Post.with_relations(posts).all()
+    g.viewer.load(posts=posts)
+    return render_template('search.html', title='Search Results', posts=posts,
                            next_url=next_url, prev_url=prev_url)
 
 @bp.route('/translate', methods=['POST'])
 @login_required
 def translate_text():
-    dest = request.form['dest_language']
-    if dest == 'zh': dest = 'zh-tw'
     # from googletrans import LANGUAGES # all language codes
-    return jsonify({'text': Translator().translate(
-        text=request.form['text'],src=request.form['source_language'],dest=dest).text})
\ No newline at end of file
+    return jsonify({'text': translate([request.form['text']],
+                                      request.form['source_language'],
+                                      request.form['dest_language'])[0]})
+
+def valid_translation_item(item, max_length):
+    if not isinstance(item, dict):
+        return False
+    id = item.get('id')
+    text = item.get('text')
+    source = item.get('source_language')
+    return (isinstance(id, (int, str)) and not isinstance(id, bool) and
+            isinstance(text, str) and len(text) <= max_length and
+            valid_language(source))
+
+def valid_language(code):
+    # stored in the five character Translation.source and dest columns
+    return isinstance(code, str) and 0 < len(code) <= 5
+
+@bp.route('/translate/batch', methods=['POST'])
+@login_required
+def translate_batch():
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return jsonify({'error': 'expected a JSON object'}), 400
+    dest = data.get('dest_language')
+    items = data.get('items')
+    if not valid_language(dest):
+        return jsonify({'error': 'dest_language must be a language code'}), 400
+    if not isinstance(items, list):
+        return jsonify({'error': 'items must be a list'}), 400
+    if len(items) > current_app.config['TRANSLATION_BATCH_SIZE']:
+        return jsonify({'error': 'at most {} items per batch'.format(
+            current_app.config['TRANSLATION_BATCH_SIZE'])}), 400
+    max_length = current_app.config['TRANSLATION_MAX_LENGTH']
+    if not all(valid_translation_item(item, max_length) for item in items):
+        return jsonify({'error': 'each item needs an id, a text of at most {} characters '
+                                 'and a source_language code'.format(max_length)}), 400
+    # one translator call per source language on the page
+    by_source = {}
+    for item in items:
+        by_source.setdefault(item['source_language'], []).append(item)
+    translations = {}
+    for source, group in by_source.items():
+        texts = translate([item['text'] for item in group], source, dest)
+        for item, text in zip(group, texts):
+            # ids may be numbers or strings, JSON object keys are strings
+            translations[str(item['id'])] = text
+    return jsonify({'translations': translations})
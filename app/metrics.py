@@ -0,0 +1,178 @@
+import threading
+from collections import defaultdict
+from contextlib import contextmanager, nullcontext
+from time import perf_counter
+from flask import Response, g, has_app_context, request, before_render_template, \
+    template_rendered
+from app import db
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+class Instrumentation(object):
+    """Per-request timing of SQL, templates and external calls.
+
+    When METRICS_ENABLED is off nothing is hooked into the app or the engine
+    and timer() hands back a no-op context manager, so the only cost left is
+    that call. When on, totals per endpoint are exported in the Prometheus
+    text format on /metrics, requests slower than SLOW_REQUEST_THRESHOLD
+    seconds are logged with their slowest statements, and METRICS_SERVER_TIMING
+    adds a Server-Timing header to every response.
+    """
+    def __init__(self, app):
+        self.app = app
+        self.enabled = app.config['METRICS_ENABLED']
+        self.server_timing = app.config['METRICS_SERVER_TIMING']
+        self.slow_threshold = app.config['SLOW_REQUEST_THRESHOLD']
+        self.lock = threading.Lock()
+        self.requests = defaultdict(int)
+        self.durations = defaultdict(lambda: [0] * (len(BUCKETS) + 1) + [0.0])
+        self.totals = defaultdict(float)
+        self.calls = defaultdict(lambda: [0, 0.0])
+        if not self.enabled:
+            return
+
+        with app.app_context():
+            for engine in db.engines.values():
+                db.event.listen(engine, 'before_cursor_execute', self.before_cursor_execute)
+                db.event.listen(engine, 'after_cursor_execute', self.after_cursor_execute)
+        before_render_template.connect(self.before_render, app)
+        template_rendered.connect(self.after_render, app)
+        app.before_request(self.before_request)
+        app.after_request(self.after_request)
+        app.add_url_rule('/metrics', 'metrics', self.export)
+
+    def timer(self, name):
+        if not self.enabled:
+            return nullcontext()
+        return self._timer(name)
+
+    @contextmanager
+    def _timer(self, name):
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = perf_counter() - start
+            with self.lock:
+                self.calls[name][0] += 1
+                self.calls[name][1] += elapsed
+            stats = self.current()
+            if stats is not None:
+                stats['external'][name] = stats['external'].get(name, 0.0) + elapsed
+
+    def current(self):
+        return g.get('request_stats') if has_app_context() else None
+
+    def before_request(self):
+        g.request_stats = {'start': perf_counter(), 'statements': [], 'sql': 0.0,
+                           'templates': 0.0, 'depth': 0, 'external': {}}
+
+    def before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('query_start', []).append(perf_counter())
+
+    def after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        elapsed = perf_counter() - conn.info['query_start'].pop()
+        stats = self.current()
+        if stats is not None:
+            stats['statements'].append((elapsed, statement))
+            stats['sql'] += elapsed
+
+    def before_render(self, app, template, context):
+        stats = self.current()
+        if stats is not None:
+            # fragments are rendered inside pages, only time the outermost template
+            if stats['depth'] == 0:
+                stats['render_start'] = perf_counter()
+            stats['depth'] += 1
+
+    def after_render(self, app, template, context):
+        stats = self.current()
+        if stats is not None and stats['depth']:
+            stats['depth'] -= 1
+            if stats['depth'] == 0:
+                stats['templates'] += perf_counter() - stats['render_start']
+
+    def after_request(self, response):
+        stats = g.pop('request_stats', None)
+        if stats is None:
+            return response
+        elapsed = perf_counter() - stats['start']
+        endpoint = request.endpoint or 'unknown'
+        with self.lock:
+            self.requests[(endpoint, request.method, response.status_code)] += 1
+            histogram = self.durations[endpoint]
+            for i, bound in enumerate(BUCKETS):
+                if elapsed <= bound:
+                    histogram[i] += 1
+            histogram[len(BUCKETS)] += 1
+            histogram[-1] += elapsed
+            self.totals[('sql_statements', endpoint)] += len(stats['statements'])
+            self.totals[('sql_seconds', endpoint)] += stats['sql']
+            self.totals[('template_seconds', endpoint)] += stats['templates']
+
+        if elapsed >= self.slow_threshold:
+            slowest = sorted(stats['statements'], key=lambda s: s[0], reverse=True)[:5]
+            self.app.logger.warning(
+                'Slow request %s %s: %.0fms, %d queries in %.0fms, templates %.0fms%s',
+                request.method, request.full_path, elapsed * 1000, len(stats['statements']),
+                stats['sql'] * 1000, stats['templates'] * 1000,
+                ''.join('\n  %.1fms %s' % (t * 1000, s) for t, s in slowest))
+
+        if self.server_timing:
+            timings = ['sql;dur={:.1f};desc="{} queries"'.format(
+                stats['sql'] * 1000, len(stats['statements'])),
+                'tpl;dur={:.1f}'.format(stats['templates'] * 1000)]
+            timings += ['{};dur={:.1f}'.format(name, t * 1000)
+                        for name, t in stats['external'].items()]
+            timings.append('total;dur={:.1f}'.format(elapsed * 1000))
+            response.headers['Server-Timing'] = ', '.join(timings)
+        return response
+
+    def export(self):
+        lines = []
+        def header(name, kind, help):
+            lines.append('# HELP microblog_{} {}'.format(name, help))
+            lines.append('# TYPE microblog_{} {}'.format(name, kind))
+        def sample(name, value, **labels):
+            labels = ','.join('{}="{}"'.format(k, v) for k, v in labels.items())
+            lines.append('microblog_{}{} {}'.format(name, '{' + labels + '}' if labels else '', value))
+
+        with self.lock:
+            header('requests_total', 'counter', 'HTTP requests handled.')
+            for (endpoint, method, status), n in sorted(self.requests.items()):
+                sample('requests_total', n, endpoint=endpoint, method=method, status=status)
+            header('request_duration_seconds', 'histogram', 'Request latency.')
+            for endpoint, histogram in sorted(self.durations.items()):
+                for bound, n in zip(BUCKETS + ('+Inf',), histogram):
+                    sample('request_duration_seconds_bucket', n, endpoint=endpoint, le=bound)
+                sample('request_duration_seconds_sum', histogram[-1], endpoint=endpoint)
+                sample('request_duration_seconds_count', histogram[len(BUCKETS)],
+                       endpoint=endpoint)
+            for name, help in (('sql_statements', 'SQL statements executed.'),
+                               ('sql_seconds', 'Time spent in SQL statements.'),
+                               ('template_seconds', 'Time spent rendering templates.')):
+                header(name + '_total', 'counter', help)
+                for (total, endpoint), value in sorted(self.totals.items()):
+                    if total == name:
+                        sample(name + '_total', value, endpoint=endpoint)
+            header('external_calls_total', 'counter', 'Calls to external services.')
+            for service, (n, _) in sorted(self.calls.items()):
+                sample('external_calls_total', n, service=service)
+            header('external_call_seconds_total', 'counter', 'Time spent in external services.')
+            for service, (_, seconds) in sorted(self.calls.items()):
+                sample('external_call_seconds_total', seconds, service=service)
+
+        mail = self.app.mail_pool.metrics()
+        header('mail_queue_depth', 'gauge', 'Emails waiting to be sent.')
+        sample('mail_queue_depth', mail['queue_depth'])
+        header('mail_total', 'counter', 'Emails by outcome.')
+        for outcome in ('sent', 'failed', 'rejected'):
+            sample('mail_total', mail[outcome], outcome=outcome)
+        header('mail_send_seconds_total', 'counter', 'Time spent sending email.')
+        sample('mail_send_seconds_total', mail['send_seconds'])
+        header('cache_lookups_total', 'counter', 'Fragment and translation cache lookups.')
+        for result, n in sorted(self.app.fragment_cache.stats.items()):
+            sample('cache_lookups_total', n, cache='fragment', result=result)
+        for result, n in sorted(self.app.translation_cache.stats.items()):
+            sample('cache_lookups_total', n, cache='translation', result=result)
+        return Response('\n'.join(lines) + '\n', mimetype='text/plain; version=0.0.4')
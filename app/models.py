@@ -1,27 +1,96 @@
+from collections import Counter
 from datetime import datetime
 from hashlib import md5
+from itertools import groupby
+from math import log2
 from time import time
-from flask import current_app
+from flask import current_app, url_for
 from flask_login import UserMixin
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm import validates
+from sqlalchemy.orm.attributes import set_committed_value
+from sqlalchemy.sql.expression import ClauseElement
 from werkzeug.security import generate_password_hash, check_password_hash
 from app import db, login
 import jwt, json, re
-from app.search import add_to_index, remove_from_index, query_index
+from app.search import update_index, flush_index, query_index
 
 followers = db.Table('followers',
-    db.Column('follower_id', db.Integer, db.ForeignKey('user.id')),
-    db.Column('followed_id', db.Integer, db.ForeignKey('user.id'))
+    db.Column('follower_id', db.Integer, db.ForeignKey('user.id'), primary_key=True),
+    db.Column('followed_id', db.Integer, db.ForeignKey('user.id'), primary_key=True),
+    db.Index('ix_followers_followed_id', 'followed_id', 'follower_id')
 )
 
 likes = db.Table('likes',
-    db.Column('user_id', db.Integer, db.ForeignKey('user.id')),
-    db.Column('post_id', db.Integer, db.ForeignKey('post.id'))
+    db.Column('user_id', db.Integer, db.ForeignKey('user.id'), primary_key=True),
+    db.Column('post_id', db.Integer, db.ForeignKey('post.id'), primary_key=True),
+    db.Index('ix_likes_post_id', 'post_id', 'user_id')
 )
 
+post_mentions = db.Table('post_mentions',
+    db.Column('post_id', db.Integer, db.ForeignKey('post.id'), primary_key=True),
+    db.Column('user_id', db.Integer, db.ForeignKey('user.id'), primary_key=True),
+    db.Index('ix_post_mentions_user_id', 'user_id', 'post_id')
+)
+
+# unread private messages per (recipient, sender), bumped on send
+unread_messages = db.Table('unread_messages',
+    db.Column('recipient_id', db.Integer, db.ForeignKey('user.id'), primary_key=True),
+    db.Column('sender_id', db.Integer, db.ForeignKey('user.id'), primary_key=True),
+    db.Column('count', db.Integer, default=0, server_default='0')
+)
+
+# materialized home timeline, one row per (reader, post), filled on write
+timeline = db.Table('timeline',
+    db.Column('user_id', db.Integer, db.ForeignKey('user.id'), primary_key=True),
+    db.Column('post_id', db.Integer, db.ForeignKey('post.id'), primary_key=True),
+    db.Column('timestamp', db.DateTime),
+    db.Index('ix_timeline_user_id_timestamp', 'user_id', 'timestamp', 'post_id')
+)
+
+# precomputed "who to follow" candidates, rewritten by "flask suggestions update"
+follow_suggestion = db.Table('follow_suggestion',
+    db.Column('user_id', db.Integer, db.ForeignKey('user.id'), primary_key=True),
+    db.Column('suggested_id', db.Integer, db.ForeignKey('user.id'), primary_key=True),
+    db.Column('score', db.Float),
+    db.Index('ix_follow_suggestion_user_id_score', 'user_id', 'score')
+)
+
+# hot scores count half lives from this fixed moment, changing it would
+# invalidate every stored score
+HOT_SCORE_EPOCH = datetime(2020, 1, 1)
+# attempts at updating a score that keeps changing under us before giving up
+HOT_SCORE_RETRIES = 10
+
+def increment_counter(obj, name, delta=1):
+    # push the change down as "counter = counter + delta" so concurrent
+    # updates in other transactions are not lost
+    pending = obj.__dict__.get(name)
+    if isinstance(pending, ClauseElement):
+        setattr(obj, name, pending + delta)
+    elif db.inspect(obj).persistent:
+        setattr(obj, name, getattr(type(obj), name) + delta)
+    else:
+        setattr(obj, name, (getattr(obj, name) or 0) + delta)
+
+def insert_ignore(table):
+    # an INSERT that skips rows already present instead of failing, so
+    # concurrent or repeated bulk inserts of the same rows are harmless
+    dialect = db.engine.dialect.name
+    if dialect == 'postgresql':
+        return postgresql.insert(table).on_conflict_do_nothing()
+    elif dialect == 'sqlite':
+        return sqlite.insert(table).on_conflict_do_nothing()
+    elif dialect == 'mysql':
+        return table.insert().prefix_with('IGNORE')
+    return table.insert()
+
 class User(UserMixin, db.Model):
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(64), index=True, unique=True)
     email = db.Column(db.String(120), index=True, unique=True)
+    # Gravatar digest of the email, kept in step by update_avatar_hash
+    avatar_hash = db.Column(db.String(32))
     password_hash = db.Column(db.String(128))
 
     posts = db.relationship('Post', backref='author', lazy='dynamic')
@@ -46,6 +115,16 @@ class User(UserMixin, db.Model):
 
     notifications = db.relationship('Notification', backref='user', lazy='dynamic')
 
+    followers_count = db.Column(db.Integer, default=0, server_default='0')
+    followed_count = db.Column(db.Integer, default=0, server_default='0')
+
+    # bumped when a field shown in cached fragments or popups changes
+    version = db.Column(db.Integer, default=1, server_default='1')
+
+    # set when the user's follows or likes change, cleared once their
+    # follow suggestions have been recomputed
+    suggestions_stale = db.Column(db.Boolean, default=True, server_default=db.true())
+
     __type__ = 'User'
 
     def get_posts(self):
@@ -60,24 +139,48 @@ class User(UserMixin, db.Model):
     def check_password(self, password):
         return check_password_hash(self.password_hash, password)
 
+    @validates('email')
+    def update_avatar_hash(self, key, email):
+        self.avatar_hash = md5(email.lower().encode('utf-8')).hexdigest() if email else None
+        return email
+
     def avatar(self, size):
-        digest = md5(self.email.lower().encode('utf-8')).hexdigest()
+        return User.avatar_url(self.avatar_hash, size)
+
+    @staticmethod
+    def avatar_url(digest, size):
+        if current_app.config['AVATAR_PROXY']:
+            return url_for('main.avatar', digest=digest, size=size)
         return 'https://www.gravatar.com/avatar/{}?d=identicon&s={}'.format(digest, size)
 
     def follow(self, user):
         if not self.is_following(user):
             self.followed.append(user)
+            increment_counter(self, 'followed_count')
+            increment_counter(user, 'followers_count')
+            User.backfill_timeline(self.id, [user.id])
+            self.mark_suggestions_stale()
 
     def unfollow(self, user):
         if self.is_following(user):
             self.followed.remove(user)
+            increment_counter(self, 'followed_count', -1)
+            increment_counter(user, 'followers_count', -1)
+            User.clear_timeline(self.id, [user.id])
+            self.mark_suggestions_stale()
 
     def is_following(self, user):
-        return self.followed.filter(followers.c.followed_id == user.id).count() > 0
+        return db.session.query(followers.select().where(
+            followers.c.follower_id == self.id,
+            followers.c.followed_id == user.id).exists()).scalar()
 
     def followers(self):
         return self.followed.filter(followers.c.followed_id == id)
 
+    def followed_ids(self, user_ids):
+        return {id for id, in db.session.query(followers.c.followed_id).filter(
+            followers.c.follower_id == self.id, followers.c.followed_id.in_(user_ids))}
+
     def followed_posts(self):
         followed = Post.query.join(
             followers, (followers.c.followed_id == Post.user_id)).filter(
@@ -85,27 +188,183 @@ class User(UserMixin, db.Model):
         own = Post.query.filter_by(user_id=self.id)
         return followed.union(own).order_by(Post.timestamp.desc())
 
+    def timeline_posts(self):
+        return Post.query.join(timeline, timeline.c.post_id == Post.id).filter(
+            timeline.c.user_id == self.id).order_by(
+            timeline.c.timestamp.desc(), timeline.c.post_id.desc())
+
+    @staticmethod
+    def backfill_timeline(follower_id, user_ids):
+        # copy the posts of newly followed users into the follower's timeline
+        existing = db.select(timeline.c.post_id).where(
+            timeline.c.user_id == follower_id, timeline.c.post_id == Post.id)
+        db.session.execute(timeline.insert().from_select(
+            ['user_id', 'post_id', 'timestamp'],
+            db.select(db.literal(follower_id), Post.id, Post.timestamp).where(
+                Post.user_id.in_(user_ids), ~existing.exists())))
+
+    @staticmethod
+    def clear_timeline(follower_id, user_ids):
+        db.session.execute(timeline.delete().where(
+            timeline.c.user_id == follower_id,
+            timeline.c.post_id.in_(db.select(Post.id).where(Post.user_id.in_(user_ids)))))
+
+    @staticmethod
+    def existing_follows(edges):
+        pair = db.tuple_(followers.c.follower_id, followers.c.followed_id)
+        return set(db.session.query(followers.c.follower_id, followers.c.followed_id).filter(
+            pair.in_(list(edges))))
+
+    @staticmethod
+    def add_follows(edges):
+        """Insert (follower_id, followed_id) pairs in one statement.
+
+        Self follows and pairs that exist already are skipped, counters and
+        timelines are updated for the rest, which are returned sorted.
+        """
+        edges = {(a, b) for a, b in edges if a != b}
+        new = sorted(edges - User.existing_follows(edges)) if edges else []
+        if new:
+            db.session.execute(insert_ignore(followers),
+                               [{'follower_id': a, 'followed_id': b} for a, b in new])
+            User.update_follow_counts(new, 1)
+            User.mark_stale({a for a, _ in new})
+            for follower_id, group in groupby(new, lambda edge: edge[0]):
+                User.backfill_timeline(follower_id, [b for _, b in group])
+        return new
+
+    @staticmethod
+    def remove_follows(edges):
+        """The reverse of add_follows(), returns the pairs that were deleted."""
+        edges = set(edges)
+        old = sorted(User.existing_follows(edges)) if edges else []
+        if old:
+            db.session.execute(followers.delete().where(
+                db.tuple_(followers.c.follower_id, followers.c.followed_id).in_(old)))
+            User.update_follow_counts(old, -1)
+            User.mark_stale({a for a, _ in old})
+            for follower_id, group in groupby(old, lambda edge: edge[0]):
+                User.clear_timeline(follower_id, [b for _, b in group])
+        return old
+
+    @staticmethod
+    def update_follow_counts(edges, sign):
+        table = User.__table__
+        for name, counts in (('followed_count', Counter(a for a, _ in edges)),
+                             ('followers_count', Counter(b for _, b in edges))):
+            db.session.execute(
+                table.update().where(table.c.id == db.bindparam('user_id')).values(
+                    {name: table.c[name] + db.bindparam('delta')}),
+                [{'user_id': id, 'delta': sign * n} for id, n in counts.items()])
+
+    @staticmethod
+    def rebuild_timelines(user_ids=None):
+        delete = timeline.delete()
+        own = db.select(Post.user_id, Post.id, Post.timestamp)
+        followed = db.select(followers.c.follower_id, Post.id, Post.timestamp).join(
+            followers, followers.c.followed_id == Post.user_id).where(
+            followers.c.follower_id != Post.user_id)
+        if user_ids is not None:
+            delete = delete.where(timeline.c.user_id.in_(user_ids))
+            own = own.where(Post.user_id.in_(user_ids))
+            followed = followed.where(followers.c.follower_id.in_(user_ids))
+        db.session.execute(delete)
+        for select in (own, followed):
+            db.session.execute(timeline.insert().from_select(
+                ['user_id', 'post_id', 'timestamp'], select))
+
+    def suggested_users(self, limit):
+        # users followed since the suggestions were computed are left out
+        followed = db.select(followers.c.followed_id).where(
+            followers.c.follower_id == self.id, followers.c.followed_id == User.id)
+        return User.query.join(
+            follow_suggestion, follow_suggestion.c.suggested_id == User.id).filter(
+            follow_suggestion.c.user_id == self.id, ~followed.exists()).order_by(
+            follow_suggestion.c.score.desc()).limit(limit)
+
+    def mark_suggestions_stale(self):
+        # only write the row when the flag changes
+        if not self.suggestions_stale:
+            self.suggestions_stale = True
+
+    @staticmethod
+    def mark_stale(user_ids):
+        db.session.execute(User.__table__.update().where(
+            User.__table__.c.id.in_(user_ids)).values(suggestions_stale=True))
+
     def like_post(self, post):
         if not self.is_post_liked(post):
             self.post_likes.append(post)
+            increment_counter(post, 'likes_count')
+            post.add_hot_score(current_app.config['HOT_SCORE_LIKE'])
+            self.mark_suggestions_stale()
 
     def unlike_post(self, post):
         if self.is_post_liked(post):
             self.post_likes.remove(post)
+            increment_counter(post, 'likes_count', -1)
+            post.add_hot_score(-current_app.config['HOT_SCORE_LIKE'])
+            self.mark_suggestions_stale()
 
     def is_post_liked(self, post):
-        return self.post_likes.filter(likes.c.post_id == post.id).count() > 0
+        return db.session.query(likes.select().where(
+            likes.c.user_id == self.id, likes.c.post_id == post.id).exists()).scalar()
+
+    def liked_post_ids(self, post_ids):
+        return {id for id, in db.session.query(likes.c.post_id).filter(
+            likes.c.user_id == self.id, likes.c.post_id.in_(post_ids))}
 
     def new_messages(self):
-        last_read_time = self.last_message_read_time or datetime(1900, 1, 1)
-        return Message.query.filter_by(recipient=self).filter(
-            Message.timestamp > last_read_time).count()
+        return db.session.query(db.func.coalesce(db.func.sum(unread_messages.c.count), 0)).filter(
+            unread_messages.c.recipient_id == self.id).scalar()
+
+    def new_messages_by_sender(self):
+        return dict(db.session.query(unread_messages.c.sender_id, unread_messages.c.count).filter(
+            unread_messages.c.recipient_id == self.id))
+
+    def add_unread_message(self, sender):
+        # make sure the row exists, then bump it, so concurrent sends can't
+        # both try to create it
+        db.session.execute(insert_ignore(unread_messages).values(
+            recipient_id=self.id, sender_id=sender.id, count=0))
+        db.session.execute(unread_messages.update().where(
+            unread_messages.c.recipient_id == self.id,
+            unread_messages.c.sender_id == sender.id).values(
+            count=unread_messages.c.count + 1))
+
+    def mark_messages_read(self, sender=None):
+        self.last_message_read_time = datetime.utcnow()
+        delete = unread_messages.delete().where(unread_messages.c.recipient_id == self.id)
+        if sender is not None:
+            delete = delete.where(unread_messages.c.sender_id == sender.id)
+        db.session.execute(delete)
 
     def add_notification(self, name, data):
-        self.notifications.filter_by(name=name).delete()
-        n = Notification(name=name, payload_json=json.dumps(data), user=self)
-        db.session.add(n)
-        return n
+        # update in place so a burst of sends doesn't churn the table, the
+        # row is created first so concurrent sends can't both insert it
+        values = {'payload_json': json.dumps(data), 'timestamp': time()}
+        db.session.execute(insert_ignore(Notification.__table__).values(
+            user_id=self.id, name=name, **values))
+        db.session.execute(Notification.__table__.update().where(
+            Notification.user_id == self.id, Notification.name == name).values(**values))
+        # streams are woken up once the row is committed
+        db.session.info.setdefault('notified_users', set()).add(self.id)
+
+    @staticmethod
+    def reconcile_counters(first_id, last_id):
+        # recount a range of users, returns how many had drifted
+        followers_count = db.select(db.func.count()).where(
+            followers.c.followed_id == User.id).scalar_subquery()
+        followed_count = db.select(db.func.count()).where(
+            followers.c.follower_id == User.id).scalar_subquery()
+        result = db.session.execute(db.update(User).where(
+            User.id.between(first_id, last_id),
+            db.or_(User.followers_count.is_(None), User.followed_count.is_(None),
+                   User.followers_count != followers_count,
+                   User.followed_count != followed_count)).values(
+            followers_count=followers_count, followed_count=followed_count).execution_options(
+            synchronize_session=False))
+        return result.rowcount
 
     def get_reset_password_token(self, expires_in=600):
         return jwt.encode({'reset_password': self.id, 'exp': time() + expires_in},
@@ -119,13 +378,30 @@ class User(UserMixin, db.Model):
             return
         return User.query.get(id)
 
+    def get_api_token(self, expires_in=3600):
+        return jwt.encode({'api': self.id, 'exp': time() + expires_in},
+            current_app.config['SECRET_KEY'], algorithm='HS256')
+
+    @staticmethod
+    def verify_api_token(token):
+        try:
+            id = jwt.decode(token, current_app.config['SECRET_KEY'], algorithms=['HS256'])['api']
+        except:
+            return
+        return User.query.get(id)
+
+    @classmethod
+    def before_flush(cls, session, flush_context, instances):
+        for obj in session.dirty:
+            if isinstance(obj, User) and any(
+                    db.inspect(obj).attrs[name].history.has_changes()
+                    for name in ('username', 'email', 'about_me')):
+                increment_counter(obj, 'version')
+
     def __repr__(self):
         return '<User {}>'.format(self.username)
 
-def mention_user_filter(match):
-    for user in User.query.all():
-        if user.username == match:
-            return user
+db.event.listen(db.session, 'before_flush', User.before_flush)
 
 @login.user_loader
 def load_user(id):
@@ -143,33 +419,68 @@ class SearchableMixin(object):
         return cls.query.filter(cls.id.in_(ids)).order_by(db.case(when, value=cls.id)), total
 
     @classmethod
-    def before_commit(cls, session):
-        session._changes = {
-            'add': list(session.new),
-            'update': list(session.dirty),
-            'delete': list(session.deleted)
-        }
+    def before_flush(cls, session, flush_context, instances):
+        # only new, deleted and objects with an edited searchable column need
+        # reindexing, likes and counter updates leave the index alone
+        pending = session.info.setdefault('search_pending', {})
+        for obj in session.new:
+            if isinstance(obj, SearchableMixin):
+                pending[obj] = True
+        for obj in session.dirty:
+            if isinstance(obj, SearchableMixin) and any(
+                    db.inspect(obj).attrs[field].history.has_changes()
+                    for field in obj.__searchable__):
+                pending[obj] = True
+        for obj in session.deleted:
+            if isinstance(obj, SearchableMixin):
+                pending[obj] = False
+
+    @classmethod
+    def after_flush(cls, session, flush_context):
+        # ids are assigned now, record the payloads until the commit
+        pending = session.info.pop('search_pending', None)
+        if not pending:
+            return
+        changes = session.info.setdefault('search_changes', {})
+        for obj, add in pending.items():
+            key = (obj.__tablename__, obj.id)
+            if add:
+                changes[key] = {field: getattr(obj, field) for field in obj.__searchable__}
+            else:
+                changes[key] = None
 
     @classmethod
     def after_commit(cls, session):
-        for obj in session._changes['add']:
-            if isinstance(obj, SearchableMixin):
-                add_to_index(obj.__tablename__, obj)
-        for obj in session._changes['update']:
-            if isinstance(obj, SearchableMixin):
-                add_to_index(obj.__tablename__, obj)
-        for obj in session._changes['delete']:
-            if isinstance(obj, SearchableMixin):
-                remove_from_index(obj.__tablename__, obj)
-        session._changes = None
+        changes = session.info.pop('search_changes', None)
+        if changes:
+            try:
+                update_index(changes)
+            except Exception:
+                # the write itself is committed, Post.reindex() repairs the index
+                current_app.logger.exception('Search index update failed')
 
     @classmethod
-    def reindex(cls):
-        for obj in cls.query:
-            add_to_index(cls.__tablename__, obj)
+    def after_rollback(cls, session):
+        session.info.pop('search_pending', None)
+        session.info.pop('search_changes', None)
 
-db.event.listen(db.session, 'before_commit', SearchableMixin.before_commit)
+    @classmethod
+    def reindex(cls):
+        batch_size = current_app.config['SEARCH_INDEX_BATCH_SIZE']
+        changes = {}
+        for obj in cls.query.yield_per(batch_size):
+            changes[(cls.__tablename__, obj.id)] = {
+                field: getattr(obj, field) for field in cls.__searchable__}
+            if len(changes) >= batch_size:
+                update_index(changes)
+                changes = {}
+        update_index(changes)
+        flush_index()
+
+db.event.listen(db.session, 'before_flush', SearchableMixin.before_flush)
+db.event.listen(db.session, 'after_flush', SearchableMixin.after_flush)
 db.event.listen(db.session, 'after_commit', SearchableMixin.after_commit)
+db.event.listen(db.session, 'after_rollback', SearchableMixin.after_rollback)
 
 class Post(SearchableMixin, db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -177,41 +488,171 @@ class Post(SearchableMixin, db.Model):
     timestamp = db.Column(db.DateTime, index=True, default=datetime.utcnow)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
     language = db.Column(db.String(5))
+    # body split into [text, mentioned user id or None] pairs, as JSON
+    body_segments = db.Column(db.Text)
+
+    likes_count = db.Column(db.Integer, default=0, server_default='0')
+    comments_count = db.Column(db.Integer, default=0, server_default='0')
+
+    # bumped when the body changes, see User.version
+    version = db.Column(db.Integer, default=1, server_default='1')
+
+    # log2 of the time decayed engagement plus the half lives elapsed since
+    # HOT_SCORE_EPOCH, which orders posts by their current engagement
+    # without ever rewriting idle rows, see add_hot_score()
+    hot_score = db.Column(db.Float, default=0, server_default='0')
 
     parent_id = db.Column(db.Integer, db.ForeignKey('post.id'))
 
-    comment = db.relationship('Post', remote_side='Post.id',
+    parent = db.relationship('Post', remote_side='Post.id',
         backref=db.backref('comments', lazy='dynamic'))
 
     user_likes = db.relationship(
         'User', secondary=likes, primaryjoin=(likes.c.post_id == id),
         backref=db.backref('liked_posts', lazy='dynamic'), lazy='dynamic')
 
+    mentions = db.relationship(
+        'User', secondary=post_mentions,
+        backref=db.backref('mentioned_in', lazy='dynamic'))
+
     __searchable__ = ['body']
     __type__ = 'Post'
+    __table_args__ = (
+        db.Index('ix_post_user_id_timestamp', 'user_id', 'timestamp'),
+        db.Index('ix_post_parent_id_timestamp', 'parent_id', 'timestamp'),
+        db.Index('ix_post_hot_score', 'hot_score', 'id'),
+    )
 
     def is_comment(self):
         return self.parent_id is not None
 
-    def get_comment_parent(self):
-        if self.is_comment():
-            return Post.query.get(self.parent_id)
+    @classmethod
+    def with_relations(cls, query):
+        # load everything comp/_post.html touches in a fixed number of queries
+        parent = db.aliased(Post)
+        return query.options(
+            db.joinedload(cls.author),
+            db.joinedload(cls.parent.of_type(parent)).joinedload(parent.author),
+            db.selectinload(cls.mentions))
 
     def display_body_data(self):
-        if self.body.count('@') >= 1:
-            # filter out mentions of invalid users
-            users = list(filter(lambda x: mention_user_filter(x), re.findall(r'\B@(\w+)', self.body)))
+        # pairs of (text, mentioned user or None), resolved when the post was written
+        if self.body_segments is None:
+            return [(self.body, None)]
+        users = {user.id: user for user in self.mentions}
+        return [(text, users.get(user_id)) for text, user_id in json.loads(self.body_segments)]
+
+    @staticmethod
+    def resolve_mentions(posts):
+        names = set()
+        for post in posts:
+            names.update(re.findall(r'\B@(\w+)', post.body or ''))
+        users = {}
+        if names:
+            users = {user.username: user for user in
+                     User.query.filter(User.username.in_(names))}
+        for post in posts:
             # split post body so mentions are seperated elements (allows them to be linked)
             # filter removes empty strings at beginning + end of list
-            mention_split = list(filter(None, re.split(r'(\B@\w+)', self.body)))
-            post_data = (mention_split, users)
-        else:
-            post_data = self.body
-        return post_data
+            segments = []
+            mentioned = []
+            for segment in filter(None, re.split(r'(\B@\w+)', post.body or '')):
+                user = users.get(segment[1:]) if re.fullmatch(r'@\w+', segment) else None
+                segments.append([segment, user.id if user else None])
+                if user is not None and user not in mentioned:
+                    mentioned.append(user)
+            post.body_segments = json.dumps(segments)
+            post.mentions = mentioned
+
+    @staticmethod
+    def hot_value(engagement, when):
+        """The hot_score of ``engagement`` points measured at ``when``."""
+        half_lives = (when - HOT_SCORE_EPOCH).total_seconds() / \
+            current_app.config['HOT_SCORE_HALF_LIFE']
+        return half_lives + log2(max(engagement, current_app.config['HOT_SCORE_MIN']))
+
+    def add_hot_score(self, weight):
+        now = datetime.utcnow()
+        if not db.inspect(self).persistent:
+            self.hot_score = Post.hot_value(weight, now)
+            return
+        # the new value depends on the old one, so write it only if nobody
+        # changed the score since it was read and try again otherwise
+        table = Post.__table__
+        old = self.hot_score
+        for _ in range(HOT_SCORE_RETRIES):
+            engagement = 2 ** (old - Post.hot_value(1, now)) if old else 0
+            new = Post.hot_value(engagement + weight, now)
+            if db.session.execute(table.update().where(
+                    table.c.id == self.id, table.c.hot_score == old).values(
+                    hot_score=new)).rowcount:
+                set_committed_value(self, 'hot_score', new)
+                return
+            row = db.session.query(Post.hot_score).filter(Post.id == self.id).first()
+            if row is None:
+                # the post was deleted, there is nothing left to rank
+                return
+            old = row.hot_score
+        current_app.logger.warning('Gave up updating the hot score of post %s', self.id)
+
+    @staticmethod
+    def reconcile_counters(first_id, last_id):
+        # recount a range of posts, returns how many had drifted
+        parent = db.aliased(Post)
+        likes_count = db.select(db.func.count()).where(
+            likes.c.post_id == Post.id).scalar_subquery()
+        comments_count = db.select(db.func.count()).select_from(parent).where(
+            parent.parent_id == Post.id).scalar_subquery()
+        result = db.session.execute(db.update(Post).where(
+            Post.id.between(first_id, last_id),
+            db.or_(Post.likes_count.is_(None), Post.comments_count.is_(None),
+                   Post.likes_count != likes_count,
+                   Post.comments_count != comments_count)).values(
+            likes_count=likes_count, comments_count=comments_count).execution_options(
+            synchronize_session=False))
+        return result.rowcount
 
     def __repr__(self):
         return '<Post {}>'.format(self.body)
 
+    @classmethod
+    def before_flush(cls, session, flush_context, instances):
+        for obj in session.new:
+            if isinstance(obj, Post) and obj.hot_score is None:
+                obj.hot_score = Post.hot_value(current_app.config['HOT_SCORE_POST'],
+                                               obj.timestamp or datetime.utcnow())
+        for obj in list(session.new):
+            if isinstance(obj, Post) and (obj.parent is not None or obj.parent_id is not None):
+                parent = obj.parent or session.get(Post, obj.parent_id)
+                increment_counter(parent, 'comments_count')
+                parent.add_hot_score(current_app.config['HOT_SCORE_COMMENT'])
+        posts = [obj for obj in session.new
+                 if isinstance(obj, Post) and obj.body_segments is None]
+        edited = [obj for obj in session.dirty if isinstance(obj, Post)
+                  and db.inspect(obj).attrs.body.history.has_changes()]
+        for post in edited:
+            increment_counter(post, 'version')
+        posts += edited
+        if posts:
+            cls.resolve_mentions(posts)
+
+    @classmethod
+    def after_flush(cls, session, flush_context):
+        # fan new posts out to the timelines of the author and their followers
+        for obj in session.new:
+            if isinstance(obj, Post):
+                session.execute(timeline.insert().values(
+                    user_id=obj.user_id, post_id=obj.id, timestamp=obj.timestamp))
+                session.execute(timeline.insert().from_select(
+                    ['user_id', 'post_id', 'timestamp'],
+                    db.select(followers.c.follower_id, db.literal(obj.id),
+                              db.literal(obj.timestamp, db.DateTime)).where(
+                        followers.c.followed_id == obj.user_id,
+                        followers.c.follower_id != obj.user_id)))
+
+db.event.listen(db.session, 'before_flush', Post.before_flush)
+db.event.listen(db.session, 'after_flush', Post.after_flush)
+
 class Message(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     sender_id = db.Column(db.Integer, db.ForeignKey('user.id'))
@@ -219,6 +660,14 @@ class Message(db.Model):
     body = db.Column(db.String(140))
     timestamp = db.Column(db.DateTime, index=True, default=datetime.utcnow)
 
+    __table_args__ = (
+        db.Index('ix_message_recipient_id_timestamp', 'recipient_id', 'timestamp'),
+    )
+
+    @classmethod
+    def with_relations(cls, query):
+        return query.options(db.joinedload(cls.sender))
+
     def __repr__(self):
         return '<Message {}>'.format(self.body)
 
@@ -229,8 +678,47 @@ class Notification(db.Model):
     timestamp = db.Column(db.Float, index=True, default=time)
     payload_json = db.Column(db.Text)
 
+    __table_args__ = (
+        db.UniqueConstraint('user_id', 'name', name='uq_notification_user_id_name'),
+        db.Index('ix_notification_user_id_timestamp', 'user_id', 'timestamp'),
+    )
+
     def get_data(self):
         return json.loads(str(self.payload_json))
 
+    @staticmethod
+    def since(user_id, since):
+        return Notification.query.filter(
+            Notification.user_id == user_id, Notification.timestamp > since).order_by(
+            Notification.timestamp.asc())
+
+    @classmethod
+    def after_commit(cls, session):
+        user_ids = session.info.pop('notified_users', None)
+        if user_ids:
+            for user_id in user_ids:
+                current_app.notification_broker.publish(user_id)
+
+    @classmethod
+    def after_rollback(cls, session):
+        session.info.pop('notified_users', None)
+
+    def __repr__(self):
+        return '<Notification {}>'.format(self.get_data())
+
+db.event.listen(db.session, 'after_commit', Notification.after_commit)
+db.event.listen(db.session, 'after_rollback', Notification.after_rollback)
+
+class Translation(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    body_hash = db.Column(db.String(64))
+    source = db.Column(db.String(5))
+    dest = db.Column(db.String(5))
+    text = db.Column(db.Text)
+
+    __table_args__ = (
+        db.UniqueConstraint('body_hash', 'source', 'dest', name='uq_translation_body_hash'),
+    )
+
     def __repr__(self):
-        return '<Notification {}>'.format(self.get_data())
\ No newline at end of file
+        return '<Translation {}>'.format(self.text)
\ No newline at end of file
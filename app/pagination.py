@@ -0,0 +1,117 @@
+import base64
+import binascii
+import json
+import math
+from datetime import datetime
+from sqlalchemy import and_, or_
+from sqlalchemy.types import DateTime, Integer, Numeric, String
+
+
+class CursorPage(object):
+    """One page of a keyset paginated query.
+
+    ``next_cursor`` is passed back as ``before=`` to get the following page and
+    ``prev_cursor`` as ``after=`` to get the preceding one. ``total`` is only
+    filled in when the page was requested with ``with_total=True``.
+    """
+    def __init__(self, items, next_cursor=None, prev_cursor=None, total=None):
+        self.items = items
+        self.next_cursor = next_cursor
+        self.prev_cursor = prev_cursor
+        self.total = total
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+    @property
+    def has_prev(self):
+        return self.prev_cursor is not None
+
+
+def encode_cursor(values):
+    data = [['d', v.isoformat()] if isinstance(v, datetime) else v for v in values]
+    token = base64.urlsafe_b64encode(json.dumps(data, separators=(',', ':')).encode())
+    return token.decode().rstrip('=')
+
+
+def decode_cursor(token):
+    try:
+        data = json.loads(base64.urlsafe_b64decode(token + '=' * (-len(token) % 4)))
+        if not isinstance(data, list):
+            return None
+        return [datetime.fromisoformat(v[1]) if isinstance(v, list) else v for v in data]
+    except (binascii.Error, ValueError, TypeError, IndexError):
+        return None
+
+
+def _matches(column, value):
+    # a tampered cursor must not reach the WHERE clause with the wrong types
+    type = column.type
+    if isinstance(type, DateTime):
+        return isinstance(value, datetime)
+    if isinstance(value, bool):
+        return False
+    if isinstance(type, Integer):
+        return isinstance(value, int)
+    if isinstance(type, Numeric):
+        return isinstance(value, (int, float)) and math.isfinite(value)
+    if isinstance(type, String):
+        return isinstance(value, str)
+    return True
+
+
+def _valid_cursor(columns, values):
+    return values is not None and len(values) == len(columns) and all(
+        _matches(column, value) for column, value in zip(columns, values))
+
+
+def _seek(columns, values, descending):
+    # (c1, c2, ...) < (v1, v2, ...) written out so it works on every backend
+    clauses = []
+    for i, column in enumerate(columns):
+        step = column < values[i] if descending else column > values[i]
+        clauses.append(and_(*[columns[j] == values[j] for j in range(i)], step))
+    return or_(*clauses)
+
+
+def cursor_paginate(query, columns, per_page, before=None, after=None,
+                    key=None, descending=True, with_total=False):
+    """Paginate ``query`` by seeking past the last row seen instead of OFFSET.
+
+    ``columns`` is the sort key, which must be unique (end it with a primary
+    key), and ``key`` extracts the same values from a result row; it defaults
+    to reading the attributes named like the columns.
+    """
+    if key is None:
+        key = lambda item: tuple(getattr(item, column.key) for column in columns)
+    total = query.order_by(None).count() if with_total else None
+
+    before = decode_cursor(before) if before else None
+    after = decode_cursor(after) if after else None
+    if not _valid_cursor(columns, before):
+        before = None
+    if not _valid_cursor(columns, after):
+        after = None
+
+    if before is None and after is not None:
+        # walk backwards from the cursor, then flip the rows into page order
+        ordering = [c.asc() if descending else c.desc() for c in columns]
+        rows = query.order_by(None).filter(_seek(columns, after, not descending)).order_by(
+            *ordering).limit(per_page + 1).all()
+        items = list(reversed(rows[:per_page]))
+        has_prev = len(rows) > per_page
+        has_next = True
+    else:
+        ordering = [c.desc() if descending else c.asc() for c in columns]
+        q = query.order_by(None)
+        if before is not None:
+            q = q.filter(_seek(columns, before, descending))
+        rows = q.order_by(*ordering).limit(per_page + 1).all()
+        items = rows[:per_page]
+        has_next = len(rows) > per_page
+        has_prev = before is not None
+
+    next_cursor = encode_cursor(key(items[-1])) if has_next and items else None
+    prev_cursor = encode_cursor(key(items[0])) if has_prev and items else None
+    return CursorPage(items, next_cursor, prev_cursor, total)
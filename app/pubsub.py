@@ -0,0 +1,85 @@
+import threading
+
+class LocalSubscription(object):
+    def __init__(self, broker, user_id):
+        self.broker = broker
+        self.user_id = user_id
+        self.event = threading.Event()
+
+    def wait(self, timeout):
+        """Block until something is published for the user, or the timeout."""
+        published = self.event.wait(timeout)
+        self.event.clear()
+        return published
+
+    def close(self):
+        self.broker.unsubscribe(self)
+
+class LocalBroker(object):
+    """Wakes up notification streams waiting in this process."""
+    def __init__(self, app):
+        self.subscriptions = {}
+        self.lock = threading.Lock()
+
+    def subscribe(self, user_id):
+        subscription = LocalSubscription(self, user_id)
+        with self.lock:
+            self.subscriptions.setdefault(user_id, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self.lock:
+            waiting = self.subscriptions.get(subscription.user_id, set())
+            waiting.discard(subscription)
+            if not waiting:
+                self.subscriptions.pop(subscription.user_id, None)
+
+    def publish(self, user_id):
+        with self.lock:
+            waiting = list(self.subscriptions.get(user_id, ()))
+        for subscription in waiting:
+            subscription.event.set()
+
+class RedisSubscription(object):
+    def __init__(self, pubsub):
+        self.pubsub = pubsub
+
+    def wait(self, timeout):
+        return self.pubsub.get_message(ignore_subscribe_messages=True,
+                                       timeout=timeout) is not None
+
+    def close(self):
+        self.pubsub.close()
+
+class RedisBroker(object):
+    """Shares notifications between worker processes through Redis pub/sub."""
+    def __init__(self, app):
+        import redis
+        self.redis = redis.Redis.from_url(app.config['REDIS_URL'])
+        self.logger = app.logger
+
+    def channel(self, user_id):
+        return 'microblog:notifications:{}'.format(user_id)
+
+    def subscribe(self, user_id):
+        pubsub = self.redis.pubsub()
+        pubsub.subscribe(self.channel(user_id))
+        # consume the subscribe confirmation so wait() only sees publishes
+        pubsub.get_message(timeout=1)
+        return RedisSubscription(pubsub)
+
+    def publish(self, user_id):
+        # called after the commit, so a Redis outage must not fail the request;
+        # streams still find the notification on their next keepalive recheck
+        try:
+            self.redis.publish(self.channel(user_id), '1')
+        except Exception:
+            self.logger.exception('Could not publish a notification for user %s', user_id)
+
+brokers = {
+    'local': LocalBroker,
+    'redis': RedisBroker,
+}
+
+def create_broker(app):
+    return brokers[app.config['NOTIFICATION_BROKER']](app)
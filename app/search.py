@@ -1,24 +1,298 @@
+import atexit
+import re
+import threading
+from collections import OrderedDict
 from flask import current_app
+from elasticsearch import Elasticsearch, helpers
+from sqlalchemy import text
+from sqlalchemy.engine import make_url
+from app import db
+
+class BulkIndexer(object):
+    """Write-behind queue of index changes, flushed with the bulk API.
+
+    Repeated changes to the same document are coalesced so only the latest
+    one is sent. A background thread flushes the queue once it holds
+    SEARCH_INDEX_BATCH_SIZE documents or every SEARCH_INDEX_FLUSH_INTERVAL
+    seconds, and documents that fail are queued again up to
+    SEARCH_INDEX_MAX_RETRIES times.
+    """
+    def __init__(self, app, client):
+        self.client = client
+        self.logger = app.logger
+        self.instrumentation = app.instrumentation
+        self.batch_size = app.config['SEARCH_INDEX_BATCH_SIZE']
+        self.interval = app.config['SEARCH_INDEX_FLUSH_INTERVAL']
+        self.max_retries = app.config['SEARCH_INDEX_MAX_RETRIES']
+        self.pending = OrderedDict()
+        self.attempts = {}
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        atexit.register(self.flush)
+
+    def add(self, index, id, payload):
+        self._queue((index, id), payload)
+
+    def remove(self, index, id):
+        self._queue((index, id), None)
+
+    def _queue(self, key, payload):
+        with self.lock:
+            self.pending[key] = payload
+            self.pending.move_to_end(key)
+            self.attempts.pop(key, None)
+            full = len(self.pending) >= self.batch_size
+        if full:
+            self.wakeup.set()
+
+    def run(self):
+        while True:
+            self.wakeup.wait(self.interval)
+            self.wakeup.clear()
+            try:
+                self.flush()
+            except Exception:
+                self.logger.exception('Search index flush failed')
+
+    def flush(self):
+        with self.flush_lock:
+            with self.lock:
+                batch, self.pending = self.pending, OrderedDict()
+            if not batch:
+                return 0
+            try:
+                failed = self.send(batch)
+            except Exception:
+                self.logger.exception('Bulk index request failed')
+                failed = list(batch)
+            self._retry(batch, failed)
+            return len(batch) - len(failed)
+
+    def send(self, batch):
+        actions = []
+        for (index, id), payload in batch.items():
+            if payload is None:
+                actions.append({'_op_type': 'delete', '_index': index, '_id': id})
+            else:
+                actions.append({'_op_type': 'index', '_index': index, '_id': id,
+                                '_source': payload})
+        with self.instrumentation.timer('elasticsearch'):
+            _, errors = helpers.bulk(self.client, actions, raise_on_error=False,
+                                     raise_on_exception=False, ignore_status=404)
+        failed = []
+        for error in errors:
+            for info in error.values():
+                failed.append((info['_index'], int(info['_id'])))
+        return failed
+
+    def _retry(self, batch, failed):
+        failed = set(failed)
+        with self.lock:
+            for key in failed:
+                if key in self.pending:
+                    # a newer change was queued while this one was in flight
+                    continue
+                attempts = self.attempts.get(key, 0) + 1
+                if attempts > self.max_retries:
+                    self.attempts.pop(key, None)
+                    self.logger.error('Giving up indexing {} {}'.format(*key))
+                    continue
+                self.attempts[key] = attempts
+                self.pending[key] = batch[key]
+            for key in batch:
+                if key not in failed:
+                    self.attempts.pop(key, None)
+
+class ElasticsearchBackend(object):
+    def __init__(self, app):
+        self.client = Elasticsearch([app.config['ELASTICSEARCH_URL']])
+        self.instrumentation = app.instrumentation
+        self.indexer = BulkIndexer(app, self.client)
+        self.indexer.start()
+
+    def add(self, index, id, payload):
+        self.indexer.add(index, id, payload)
+
+    def remove(self, index, id):
+        self.indexer.remove(index, id)
+
+    def update(self, changes):
+        for (index, id), payload in changes.items():
+            if payload is None:
+                self.indexer.remove(index, id)
+            else:
+                self.indexer.add(index, id, payload)
+
+    def flush(self):
+        self.indexer.flush()
+
+    def query(self, index, query, page, per_page):
+        with self.instrumentation.timer('elasticsearch'):
+            search = self.client.search(
+                index=index,
+                body={'query': {'multi_match': {'query': query, 'fields': ['*']}},
+                      'from': (page - 1) * per_page, 'size': per_page})
+        ids = [int(hit['_id']) for hit in search['hits']['hits']]
+        return ids, search['hits']['total']['value']
+
+class SQLiteFullText(object):
+    """FTS5 virtual table named <index>_fts, keyed by the model's rowid."""
+    def create(self, conn, index, fields):
+        conn.execute(text('CREATE VIRTUAL TABLE IF NOT EXISTS {}_fts USING fts5({})'.format(
+            index, ', '.join(fields))))
+
+    def upsert(self, conn, index, documents):
+        fields = list(documents[0][1])
+        self.delete(conn, index, [id for id, _ in documents])
+        conn.execute(text('INSERT INTO {}_fts (rowid, {}) VALUES (:id, {})'.format(
+            index, ', '.join(fields), ', '.join(':' + f for f in fields))),
+            [dict(payload, id=id) for id, payload in documents])
+
+    def delete(self, conn, index, ids):
+        conn.execute(text('DELETE FROM {}_fts WHERE rowid = :id'.format(index)),
+                     [{'id': id} for id in ids])
+
+    def query(self, conn, index, query, page, per_page):
+        # quote every word so user input can't use the FTS query syntax
+        match = ' '.join('"{}"'.format(word) for word in re.findall(r'\w+', query))
+        if not match:
+            return [], 0
+        total = conn.execute(text('SELECT count(*) FROM {0}_fts WHERE {0}_fts MATCH :q'.format(
+            index)), {'q': match}).scalar()
+        ids = conn.execute(text(
+            'SELECT rowid FROM {0}_fts WHERE {0}_fts MATCH :q ORDER BY rank '
+            'LIMIT :limit OFFSET :offset'.format(index)),
+            {'q': match, 'limit': per_page, 'offset': (page - 1) * per_page}).scalars().all()
+        return ids, total
+
+class PostgresFullText(object):
+    """<index>_fts table holding a GIN indexed tsvector per document."""
+    def create(self, conn, index, fields):
+        conn.execute(text('CREATE TABLE IF NOT EXISTS {}_fts '
+                          '(id INTEGER PRIMARY KEY, document TSVECTOR)'.format(index)))
+        conn.execute(text('CREATE INDEX IF NOT EXISTS ix_{0}_fts_document '
+                          'ON {0}_fts USING GIN (document)'.format(index)))
+
+    def upsert(self, conn, index, documents):
+        conn.execute(text(
+            "INSERT INTO {}_fts (id, document) VALUES (:id, to_tsvector('simple', :body)) "
+            "ON CONFLICT (id) DO UPDATE SET document = excluded.document".format(index)),
+            [{'id': id, 'body': ' '.join(str(v or '') for v in payload.values())}
+             for id, payload in documents])
+
+    def delete(self, conn, index, ids):
+        conn.execute(text('DELETE FROM {}_fts WHERE id = :id'.format(index)),
+                     [{'id': id} for id in ids])
+
+    def query(self, conn, index, query, page, per_page):
+        total = conn.execute(text(
+            "SELECT count(*) FROM {}_fts WHERE document @@ plainto_tsquery('simple', :q)".format(
+                index)), {'q': query}).scalar()
+        ids = conn.execute(text(
+            "SELECT id FROM {}_fts, plainto_tsquery('simple', :q) AS query "
+            "WHERE document @@ query ORDER BY ts_rank(document, query) DESC, id DESC "
+            "LIMIT :limit OFFSET :offset".format(index)),
+            {'q': query, 'limit': per_page, 'offset': (page - 1) * per_page}).scalars().all()
+        return ids, total
+
+class DatabaseBackend(object):
+    """Full-text search inside the application database.
+
+    The index changes of a commit are written together in one transaction
+    right after it, through the same hooks Elasticsearch uses, with one
+    statement per index and kind of change.
+    """
+    dialects = {
+        'sqlite': SQLiteFullText,
+        'postgresql': PostgresFullText,
+    }
+
+    def __init__(self, app):
+        self.full_text = None
+        self.created = set()
+
+    def dialect(self):
+        if self.full_text is None:
+            self.full_text = self.dialects[db.engine.dialect.name]()
+        return self.full_text
+
+    def add(self, index, id, payload):
+        self.update({(index, id): payload})
+
+    def remove(self, index, id):
+        self.update({(index, id): None})
+
+    def update(self, changes):
+        documents = {}
+        removed = {}
+        for (index, id), payload in changes.items():
+            if payload is None:
+                removed.setdefault(index, []).append(id)
+            else:
+                documents.setdefault(index, []).append((id, payload))
+        with db.engine.begin() as conn:
+            for index, ids in removed.items():
+                if index in self.created or db.inspect(conn).has_table(index + '_fts'):
+                    self.dialect().delete(conn, index, ids)
+            for index, rows in documents.items():
+                if index not in self.created:
+                    self.dialect().create(conn, index, list(rows[0][1]))
+                    self.created.add(index)
+                self.dialect().upsert(conn, index, rows)
+
+    def flush(self):
+        pass
+
+    def query(self, index, query, page, per_page):
+        with db.engine.connect() as conn:
+            if index not in self.created and not db.inspect(conn).has_table(index + '_fts'):
+                return [], 0
+            return self.dialect().query(conn, index, query, page, per_page)
+
+backends = {
+    'elasticsearch': ElasticsearchBackend,
+    'database': DatabaseBackend,
+}
+
+def create_search_backend(app):
+    name = app.config['SEARCH_BACKEND']
+    if name == 'database':
+        dialect = make_url(app.config['SQLALCHEMY_DATABASE_URI']).get_backend_name()
+        if dialect not in DatabaseBackend.dialects:
+            app.logger.warning('No full text search for %s databases, search is disabled',
+                               dialect)
+            return None
+    return backends[name](app) if name else None
 
 def add_to_index(index, model):
-    if not current_app.elasticsearch:
+    if not current_app.search_backend:
         return
     payload = {}
     for field in model.__searchable__:
         payload[field] = getattr(model, field)
-    current_app.elasticsearch.index(index=index, id=model.id, body=payload)
+    current_app.search_backend.add(index, model.id, payload)
 
 def remove_from_index(index, model):
-    if not current_app.elasticsearch:
+    if not current_app.search_backend:
         return
-    current_app.elasticsearch.delete(index=index, id=model.id)
+    current_app.search_backend.remove(index, model.id)
+
+def update_index(changes):
+    """Apply {(index, id): payload} changes at once, a None payload removes."""
+    if current_app.search_backend and changes:
+        current_app.search_backend.update(changes)
+
+def flush_index():
+    if current_app.search_backend:
+        current_app.search_backend.flush()
 
 def query_index(index, query, page, per_page):
-    if not current_app.elasticsearch:
+    if not current_app.search_backend:
         return [], 0
-    search = current_app.elasticsearch.search(
-        index=index,
-        body={'query': {'multi_match': {'query': query, 'fields': ['*']}},
-              'from': (page - 1) * per_page, 'size': per_page})
-    ids = [int(hit['_id']) for hit in search['hits']['hits']]
-    return ids, search['hits']['total']['value']
\ No newline at end of file
+    return current_app.search_backend.query(index, query, page, per_page)
@@ -0,0 +1,125 @@
+import heapq
+from collections import Counter, defaultdict
+from app import db
+from app.models import User, followers, likes, follow_suggestion
+
+try:
+    import numpy as np
+    from scipy import sparse
+except ImportError:
+    np = sparse = None
+
+def load_neighborhood(user_ids):
+    """Return the follow and like edges within two hops of ``user_ids``.
+
+    That is the follows of the users and of everyone they follow, and every
+    like of the posts they liked, which is all the scoring looks at.
+    """
+    followed = db.select(followers.c.followed_id).where(followers.c.follower_id.in_(user_ids))
+    follows = db.session.query(followers.c.follower_id, followers.c.followed_id).filter(
+        db.or_(followers.c.follower_id.in_(user_ids), followers.c.follower_id.in_(followed)))
+    liked = db.select(likes.c.post_id).where(likes.c.user_id.in_(user_ids))
+    post_likes = db.session.query(likes.c.user_id, likes.c.post_id).filter(
+        likes.c.post_id.in_(liked))
+    return follows.all(), post_likes.all()
+
+def _top(candidates, k):
+    # highest score first, lower user id first on ties
+    return [(id, -score) for score, id in heapq.nsmallest(
+        k, ((-score, id) for id, score in candidates))]
+
+def _score_python(user_ids, follows, post_likes, k, like_weight):
+    following = defaultdict(set)
+    for a, b in follows:
+        following[a].add(b)
+    likers = defaultdict(list)
+    liked = defaultdict(list)
+    for user_id, post_id in post_likes:
+        likers[post_id].append(user_id)
+        liked[user_id].append(post_id)
+
+    results = {}
+    for user_id in user_ids:
+        scores = Counter()
+        for followed_id in following[user_id]:
+            scores.update(following[followed_id])
+        for post_id in liked[user_id]:
+            for liker_id in likers[post_id]:
+                scores[liker_id] += like_weight
+        exclude = following[user_id] | {user_id}
+        results[user_id] = _top(((id, score) for id, score in scores.items()
+                                 if id not in exclude), k)
+    return results
+
+def _score_sparse(user_ids, follows, post_likes, k, like_weight):
+    ids = sorted(set(user_ids) | {a for a, _ in follows} | {b for _, b in follows} |
+                 {u for u, _ in post_likes})
+    index = {id: i for i, id in enumerate(ids)}
+    post_index = {p: i for i, p in enumerate({p for _, p in post_likes})}
+
+    def matrix(edges, columns):
+        rows = np.fromiter((index[a] for a, _ in edges), dtype=np.int64, count=len(edges))
+        cols = np.fromiter((columns[b] for _, b in edges), dtype=np.int64, count=len(edges))
+        return sparse.csr_matrix((np.ones(len(edges)), (rows, cols)),
+                                 shape=(len(ids), len(columns)))
+
+    # A[i, j] is 1 when i follows j and L[i, p] is 1 when i liked p, so
+    # (A @ A)[i, j] counts the paths i -> x -> j and (L @ L.T)[i, j] the
+    # posts both liked
+    adjacency = matrix(follows, index)
+    liked = matrix(post_likes, post_index)
+    rows = np.array([index[id] for id in user_ids], dtype=np.int64)
+    scores = (adjacency[rows] @ adjacency + like_weight * (liked[rows] @ liked.T)).tocsr()
+
+    results = {}
+    for n, user_id in enumerate(user_ids):
+        row = slice(scores.indptr[n], scores.indptr[n + 1])
+        i = rows[n]
+        exclude = set(adjacency.indices[adjacency.indptr[i]:adjacency.indptr[i + 1]]) | {i}
+        results[user_id] = _top(((ids[j], float(value))
+                                 for j, value in zip(scores.indices[row], scores.data[row])
+                                 if j not in exclude and value), k)
+    return results
+
+def score(user_ids, follows, post_likes, k=10, like_weight=0.5):
+    """Top ``k`` (user_id, score) suggestions for each of ``user_ids``.
+
+    A candidate scores one point for every followed user that follows them
+    and ``like_weight`` for every post both liked. Users already followed
+    are never suggested. SciPy sparse matrices are used when installed.
+    """
+    if sparse is not None:
+        return _score_sparse(user_ids, follows, post_likes, k, like_weight)
+    return _score_python(user_ids, follows, post_likes, k, like_weight)
+
+def update_suggestions(user_ids, k=10, like_weight=0.5):
+    """Recompute and store the suggestions of ``user_ids``, returns rows written."""
+    follows, post_likes = load_neighborhood(user_ids)
+    results = score(user_ids, follows, post_likes, k, like_weight)
+    db.session.execute(follow_suggestion.delete().where(
+        follow_suggestion.c.user_id.in_(user_ids)))
+    rows = [{'user_id': user_id, 'suggested_id': id, 'score': s}
+            for user_id, suggestions in results.items() for id, s in suggestions]
+    if rows:
+        db.session.execute(follow_suggestion.insert(), rows)
+    db.session.execute(User.__table__.update().where(
+        User.__table__.c.id.in_(user_ids)).values(suggestions_stale=False))
+    return len(rows)
+
+def update_stale(batch_size=500, k=10, like_weight=0.5):
+    """Recompute the suggestions of every stale user, one commit per batch.
+
+    Yields the number of users and of suggestions written after each batch.
+    """
+    users = suggestions = 0
+    last_id = 0
+    while True:
+        user_ids = [id for id, in db.session.query(User.id).filter(
+            User.suggestions_stale, User.id > last_id).order_by(User.id).limit(batch_size)]
+        if not user_ids:
+            break
+        suggestions += update_suggestions(user_ids, k, like_weight)
+        db.session.commit()
+        users += len(user_ids)
+        last_id = user_ids[-1]
+        yield users, suggestions
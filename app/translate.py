@@ -0,0 +1,96 @@
+import hashlib
+import threading
+from collections import OrderedDict
+from flask import current_app
+from googletrans import Translator
+from app import db
+from app.models import Translation, insert_ignore
+
+class GoogleTranslator(object):
+    def translate(self, texts, src, dest):
+        return [t.text for t in Translator().translate(texts, src=src, dest=dest)]
+
+class StaticTranslator(object):
+    """Offline stand-in that tags the text with the destination language."""
+    def translate(self, texts, src, dest):
+        return ['[{}] {}'.format(dest, text) for text in texts]
+
+translators = {
+    'google': GoogleTranslator,
+    'static': StaticTranslator,
+}
+
+def create_translator(config):
+    return translators[config['TRANSLATOR']]()
+
+class TranslationCache(object):
+    """In-process LRU in front of the translation table."""
+    def __init__(self, size):
+        self.size = size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.stats = {'memory_hits': 0, 'database_hits': 0, 'misses': 0}
+
+    def get(self, key):
+        with self.lock:
+            text = self.entries.get(key)
+            if text is not None:
+                self.entries.move_to_end(key)
+            return text
+
+    def put(self, key, text):
+        with self.lock:
+            self.entries[key] = text
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def count(self, stat, n=1):
+        with self.lock:
+            self.stats[stat] += n
+
+def body_hash(text):
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+def translate(texts, src, dest):
+    """Translate a list of texts from src to dest, using the cache tiers.
+
+    Only texts missing from both the LRU and the translation table are sent
+    to the translator, in a single call.
+    """
+    if dest == 'zh': dest = 'zh-tw'
+    cache = current_app.translation_cache
+    hashes = [body_hash(text) for text in texts]
+    results = {}
+    for h in hashes:
+        text = cache.get((h, src, dest))
+        if text is not None:
+            results[h] = text
+    cache.count('memory_hits', len(results))
+
+    missing = set(hashes) - set(results)
+    if missing:
+        for t in Translation.query.filter(Translation.body_hash.in_(missing),
+                                          Translation.source == src,
+                                          Translation.dest == dest):
+            results[t.body_hash] = t.text
+            cache.put((t.body_hash, src, dest), t.text)
+            cache.count('database_hits')
+
+    pending = OrderedDict()
+    for h, text in zip(hashes, texts):
+        if h not in results:
+            pending[h] = text
+    if pending:
+        cache.count('misses', len(pending))
+        with current_app.instrumentation.timer('translate'):
+            translated = current_app.translator.translate(list(pending.values()), src, dest)
+        rows = []
+        for h, text in zip(pending, translated):
+            results[h] = text
+            cache.put((h, src, dest), text)
+            rows.append({'body_hash': h, 'source': src, 'dest': dest, 'text': text})
+        # rows another request stored first are skipped, the rest are kept
+        db.session.execute(insert_ignore(Translation.__table__), rows)
+        db.session.commit()
+    return [results[h] for h in hashes]
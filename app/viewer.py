@@ -0,0 +1,39 @@
+class ViewerState(object):
+    """What the current user has liked and follows, for the items on a page.
+
+    Routes call load() with the posts and users they are about to render so
+    each relation is fetched with a single IN query. Templates then check
+    liked() and following(), which only query for items that were not loaded.
+    """
+    def __init__(self, user):
+        self.user = user
+        self.liked_ids = set()
+        self.followed_ids = set()
+        self.loaded_posts = set()
+        self.loaded_users = set()
+
+    def load(self, posts=(), users=()):
+        posts = list(posts)
+        # the comment header shows the parent post and its author too
+        posts += [post.parent for post in posts if post.parent_id is not None]
+        users = list(users) + [post.author for post in posts]
+        post_ids = {post.id for post in posts} - self.loaded_posts
+        user_ids = {user.id for user in users} - self.loaded_users
+        if not self.user.is_authenticated:
+            post_ids = user_ids = set()
+        if post_ids:
+            self.liked_ids |= self.user.liked_post_ids(post_ids)
+            self.loaded_posts |= post_ids
+        if user_ids:
+            self.followed_ids |= self.user.followed_ids(user_ids)
+            self.loaded_users |= user_ids
+
+    def liked(self, post):
+        if post.id not in self.loaded_posts:
+            self.load(posts=[post])
+        return post.id in self.liked_ids
+
+    def following(self, user):
+        if user.id not in self.loaded_users:
+            self.load(users=[user])
+        return user.id in self.followed_ids
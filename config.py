@@ -8,16 +8,105 @@ class Config(object):
     SECRET_KEY = os.environ.get('SECRET_KEY')
 
     SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL') or 'sqlite:///' + os.path.join(basedir, 'app.db')
-    SQLALCHEMY_TRACK_MODIFICATIONS = True
+    SQLALCHEMY_TRACK_MODIFICATIONS = False
+    # GET requests read from the replica, see app/database.py
+    DATABASE_REPLICA_URL = os.environ.get('DATABASE_REPLICA_URL')
+    # seconds a client keeps reading from the primary after it wrote something
+    DATABASE_REPLICA_STICKY = 10
+    # pool settings, ignored for SQLite
+    DATABASE_POOL_SIZE = int(os.environ.get('DATABASE_POOL_SIZE') or 10)
+    DATABASE_MAX_OVERFLOW = int(os.environ.get('DATABASE_MAX_OVERFLOW') or 20)
+    DATABASE_POOL_RECYCLE = 1800
+    DATABASE_POOL_PRE_PING = True
+    SQLITE_JOURNAL_MODE = 'WAL'
+    SQLITE_SYNCHRONOUS = 'NORMAL'
+    # milliseconds a connection waits for a lock before raising "database is locked"
+    SQLITE_BUSY_TIMEOUT = 5000
 
     ELASTICSEARCH_URL = os.environ.get('ELASTICSEARCH_URL')
+    # 'elasticsearch', 'database' (SQLite FTS5 / PostgreSQL tsvector) or empty to disable
+    SEARCH_BACKEND = os.environ.get('SEARCH_BACKEND',
+        'elasticsearch' if ELASTICSEARCH_URL else 'database')
+    SEARCH_INDEX_BATCH_SIZE = 500
+    SEARCH_INDEX_FLUSH_INTERVAL = 2
+    SEARCH_INDEX_MAX_RETRIES = 3
     LOG_TO_STDOUT = os.environ.get('LOG_TO_STDOUT')
 
+    # SQL, template and external call timings per request, exported on /metrics
+    METRICS_ENABLED = os.environ.get('METRICS_ENABLED') is not None
+    METRICS_SERVER_TIMING = os.environ.get('METRICS_SERVER_TIMING') is not None
+    SLOW_REQUEST_THRESHOLD = float(os.environ.get('SLOW_REQUEST_THRESHOLD') or 1.0)
+
     POSTS_PER_PAGE = 25
 
+    # seconds of staleness tolerated in User.last_seen, and between batched writes
+    LAST_SEEN_RESOLUTION = 60
+    LAST_SEEN_FLUSH_INTERVAL = 30
+
+    # 'local' only wakes up streams in the same process, use 'redis' with several
+    # workers; either way a stream or long-poll checks the database itself every
+    # NOTIFICATION_KEEPALIVE seconds, so nothing is missed, only delayed. Each
+    # open stream holds a worker thread, see the gthread workers in Procfile
+    NOTIFICATION_BROKER = os.environ.get('NOTIFICATION_BROKER') or 'local'
+    REDIS_URL = os.environ.get('REDIS_URL') or 'redis://'
+    NOTIFICATION_KEEPALIVE = 10
+    NOTIFICATION_STREAM_TIMEOUT = 300
+
+    LANGUAGE_DETECTOR = os.environ.get('LANGUAGE_DETECTOR') or 'google'
+    LANGUAGE_DETECTION_BATCH_SIZE = 50
+    LANGUAGE_DETECTION_INTERVAL = 5
+
+    TRANSLATOR = os.environ.get('TRANSLATOR') or 'google'
+    TRANSLATION_CACHE_SIZE = 1024
+    # limits of one /translate/batch request
+    TRANSLATION_BATCH_SIZE = 100
+    TRANSLATION_MAX_LENGTH = 1000
+
+    # serve Gravatar images from /avatar, cached on disk, instead of linking to them
+    AVATAR_PROXY = os.environ.get('AVATAR_PROXY') is not None
+    AVATAR_CACHE_DIR = os.environ.get('AVATAR_CACHE_DIR') or os.path.join(basedir, 'avatars')
+    AVATAR_FETCH_TIMEOUT = 5
+    AVATAR_MAX_AGE = 86400
+
+    # rendered posts, users and messages: 'memory' is per process, 'redis' is
+    # shared by all workers, empty disables the cache
+    FRAGMENT_CACHE = os.environ.get('FRAGMENT_CACHE', 'memory')
+    FRAGMENT_CACHE_SIZE = 10000
+    FRAGMENT_CACHE_TIMEOUT = 3600
+
+    # seconds browsers may reuse hover popups before revalidating them
+    POPUP_MAX_AGE = 60
+    LIKES_POPUP_USERS = 20
+
+    # most users one bulk follow/unfollow API request may name, and edges
+    # written per commit by "flask graph import"
+    FOLLOW_BATCH_SIZE = 1000
+
+    # "who to follow": candidates kept per user, weight of a post both users
+    # liked relative to a followed user that follows the candidate, and how
+    # many are shown on the home page
+    SUGGESTIONS_PER_USER = 20
+    SUGGESTION_LIKE_WEIGHT = 0.5
+    SUGGESTIONS_SHOWN = 5
+
+    # "hot" ranking on /explore: points per post, like and comment, worth half
+    # as much every HOT_SCORE_HALF_LIFE seconds, engagement below
+    # HOT_SCORE_MIN counts as that minimum
+    HOT_SCORE_POST = 1.0
+    HOT_SCORE_LIKE = 1.0
+    HOT_SCORE_COMMENT = 2.0
+    HOT_SCORE_HALF_LIFE = 12 * 3600
+    HOT_SCORE_MIN = 0.01
+
     MAIL_SERVER = os.environ.get('MAIL_SERVER')
     MAIL_PORT = int(os.environ.get('MAIL_PORT') or 25)
     MAIL_USE_TLS = os.environ.get('MAIL_USE_TLS') is not None
     MAIL_USERNAME = os.environ.get('MAIL_USERNAME')
     MAIL_PASSWORD = os.environ.get('MAIL_PASSWORD')
-    ADMINS = ['appdev.micro@gmail.com']
\ No newline at end of file
+    ADMINS = ['appdev.micro@gmail.com']
+    MAIL_WORKERS = 2
+    MAIL_QUEUE_SIZE = 100
+    # seconds send_email() waits for room in a full queue before giving up
+    MAIL_QUEUE_TIMEOUT = 1
+    # seconds an unused SMTP connection is kept open
+    MAIL_IDLE_TIMEOUT = 30
\ No newline at end of file
@@ -1,8 +1,9 @@
-from app import create_app, db
+from app import create_app, db, cli
 from app.models import User, Post, Message, Notification
 
 app = create_app()
+cli.register(app)
 
 @app.shell_context_processor
 def make_shell_context():
-    return {'db': db, 'User': User, 'Post': Post, 'Message': Message, 'Notification': Notification}
\ No newline at end of file
+    return {'db': db, 'User': User, 'Post': Post, 'Message': Message, 'Notification': Notification}
@@ -1,6 +1,7 @@
 from __future__ import with_statement
 
 import logging
+import re
 from logging.config import fileConfig
 
 from sqlalchemy import engine_from_config
@@ -33,6 +34,16 @@ target_metadata = current_app.extensions['migrate'].db.metadata
 # ... etc.
 
 
+def include_object(object, name, type_, reflected, compare_to):
+    # the <index>_fts full text tables of the 'database' search backend (and
+    # the shadow tables FTS5 creates for them) are managed by app/search.py
+    # and the migrations, autogenerate must not drop them
+    table = name if type_ == 'table' else getattr(getattr(object, 'table', None), 'name', '')
+    if reflected and compare_to is None and re.match(r'\w+_fts(_\w+)?$', table or ''):
+        return False
+    return True
+
+
 def run_migrations_offline():
     """Run migrations in 'offline' mode.
 
@@ -47,7 +58,8 @@ def run_migrations_offline():
     """
     url = config.get_main_option("sqlalchemy.url")
     context.configure(
-        url=url, target_metadata=target_metadata, literal_binds=True
+        url=url, target_metadata=target_metadata, literal_binds=True,
+        include_object=include_object
     )
 
     with context.begin_transaction():
@@ -78,13 +90,16 @@ def run_migrations_online():
         poolclass=pool.NullPool,
     )
 
+    # Flask-Migrate 4 passes render_as_batch itself
+    configure_args = dict(render_as_batch=True, include_object=include_object)
+    configure_args.update(current_app.extensions['migrate'].configure_args)
+
     with connectable.connect() as connection:
         context.configure(
             connection=connection,
             target_metadata=target_metadata,
             process_revision_directives=process_revision_directives,
-            render_as_batch=True,
-            **current_app.extensions['migrate'].configure_args
+            **configure_args
         )
 
         with context.begin_transaction():
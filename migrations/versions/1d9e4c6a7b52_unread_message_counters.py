@@ -0,0 +1,38 @@
+"""unread message counters
+
+Revision ID: 1d9e4c6a7b52
+Revises: f6d2a84b1c39
+Create Date: 2026-10-18 16:47:21.384519
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '1d9e4c6a7b52'
+down_revision = 'f6d2a84b1c39'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('unread_messages',
+    sa.Column('recipient_id', sa.Integer(), nullable=False),
+    sa.Column('sender_id', sa.Integer(), nullable=False),
+    sa.Column('count', sa.Integer(), server_default='0', nullable=True),
+    sa.ForeignKeyConstraint(['recipient_id'], ['user.id'], ),
+    sa.ForeignKeyConstraint(['sender_id'], ['user.id'], ),
+    sa.PrimaryKeyConstraint('recipient_id', 'sender_id')
+    )
+
+    op.execute('INSERT INTO unread_messages (recipient_id, sender_id, count) '
+               'SELECT message.recipient_id, message.sender_id, count(*) FROM message '
+               'JOIN "user" ON "user".id = message.recipient_id '
+               'WHERE "user".last_message_read_time IS NULL '
+               'OR message.timestamp > "user".last_message_read_time '
+               'GROUP BY message.recipient_id, message.sender_id')
+
+
+def downgrade():
+    op.drop_table('unread_messages')
@@ -0,0 +1,32 @@
+"""fragment versions
+
+Revision ID: 4f8a1c7e2d90
+Revises: 7c5b0e3d9f18
+Create Date: 2026-10-18 19:12:05.718264
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '4f8a1c7e2d90'
+down_revision = '7c5b0e3d9f18'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('post', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('version', sa.Integer(), server_default='1', nullable=True))
+
+    with op.batch_alter_table('user', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('version', sa.Integer(), server_default='1', nullable=True))
+
+
+def downgrade():
+    with op.batch_alter_table('user', schema=None) as batch_op:
+        batch_op.drop_column('version')
+
+    with op.batch_alter_table('post', schema=None) as batch_op:
+        batch_op.drop_column('version')
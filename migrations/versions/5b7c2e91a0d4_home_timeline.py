@@ -0,0 +1,42 @@
+"""home timeline
+
+Revision ID: 5b7c2e91a0d4
+Revises: d74d557fbab9
+Create Date: 2026-10-18 09:12:40.118204
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5b7c2e91a0d4'
+down_revision = 'd74d557fbab9'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('timeline',
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.Column('post_id', sa.Integer(), nullable=False),
+    sa.Column('timestamp', sa.DateTime(), nullable=True),
+    sa.ForeignKeyConstraint(['post_id'], ['post.id'], ),
+    sa.ForeignKeyConstraint(['user_id'], ['user.id'], ),
+    sa.PrimaryKeyConstraint('user_id', 'post_id')
+    )
+    op.create_index('ix_timeline_user_id_timestamp', 'timeline',
+                    ['user_id', 'timestamp', 'post_id'], unique=False)
+
+    # backfill from the existing follow graph
+    op.execute('INSERT INTO timeline (user_id, post_id, timestamp) '
+               'SELECT user_id, id, timestamp FROM post')
+    op.execute('INSERT INTO timeline (user_id, post_id, timestamp) '
+               'SELECT DISTINCT followers.follower_id, post.id, post.timestamp FROM post '
+               'JOIN followers ON followers.followed_id = post.user_id '
+               'WHERE followers.follower_id != post.user_id')
+
+
+def downgrade():
+    op.drop_index('ix_timeline_user_id_timestamp', table_name='timeline')
+    op.drop_table('timeline')
@@ -0,0 +1,87 @@
+"""access path indexes
+
+Revision ID: 7c5b0e3d9f18
+Revises: 1d9e4c6a7b52
+Create Date: 2026-10-18 18:12:55.470316
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '7c5b0e3d9f18'
+down_revision = '1d9e4c6a7b52'
+branch_labels = None
+depends_on = None
+
+
+def dedupe(table, columns):
+    # association rows were never constrained, drop duplicates and NULLs first
+    op.execute('CREATE TABLE {0}_dedupe AS SELECT DISTINCT {1} FROM {0} WHERE {2}'.format(
+        table, ', '.join(columns), ' AND '.join(c + ' IS NOT NULL' for c in columns)))
+    op.execute('DELETE FROM {}'.format(table))
+    op.execute('INSERT INTO {0} ({1}) SELECT {1} FROM {0}_dedupe'.format(table, ', '.join(columns)))
+    op.execute('DROP TABLE {}_dedupe'.format(table))
+
+
+def upgrade():
+    # the counters were backfilled in c41e8f7d2b05 with the duplicates still
+    # there, recount them once the duplicates are gone
+    dedupe('followers', ['follower_id', 'followed_id'])
+    op.execute('UPDATE "user" SET '
+               'followers_count = (SELECT count(*) FROM followers WHERE followed_id = "user".id), '
+               'followed_count = (SELECT count(*) FROM followers WHERE follower_id = "user".id)')
+    with op.batch_alter_table('followers', schema=None) as batch_op:
+        batch_op.alter_column('follower_id', existing_type=sa.Integer(), nullable=False)
+        batch_op.alter_column('followed_id', existing_type=sa.Integer(), nullable=False)
+        batch_op.create_primary_key('pk_followers', ['follower_id', 'followed_id'])
+        batch_op.create_index('ix_followers_followed_id', ['followed_id', 'follower_id'], unique=False)
+
+    dedupe('likes', ['user_id', 'post_id'])
+    op.execute('UPDATE post SET '
+               'likes_count = (SELECT count(*) FROM likes WHERE post_id = post.id)')
+    with op.batch_alter_table('likes', schema=None) as batch_op:
+        batch_op.alter_column('user_id', existing_type=sa.Integer(), nullable=False)
+        batch_op.alter_column('post_id', existing_type=sa.Integer(), nullable=False)
+        batch_op.create_primary_key('pk_likes', ['user_id', 'post_id'])
+        batch_op.create_index('ix_likes_post_id', ['post_id', 'user_id'], unique=False)
+
+    with op.batch_alter_table('post', schema=None) as batch_op:
+        batch_op.create_index('ix_post_user_id_timestamp', ['user_id', 'timestamp'], unique=False)
+        batch_op.create_index('ix_post_parent_id_timestamp', ['parent_id', 'timestamp'], unique=False)
+
+    with op.batch_alter_table('message', schema=None) as batch_op:
+        batch_op.create_index('ix_message_recipient_id_timestamp', ['recipient_id', 'timestamp'], unique=False)
+
+    # keep only the newest notification of each name per user
+    op.execute('DELETE FROM notification WHERE id NOT IN '
+               '(SELECT max(id) FROM notification GROUP BY user_id, name)')
+    with op.batch_alter_table('notification', schema=None) as batch_op:
+        batch_op.create_unique_constraint('uq_notification_user_id_name', ['user_id', 'name'])
+        batch_op.create_index('ix_notification_user_id_timestamp', ['user_id', 'timestamp'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('notification', schema=None) as batch_op:
+        batch_op.drop_index('ix_notification_user_id_timestamp')
+        batch_op.drop_constraint('uq_notification_user_id_name', type_='unique')
+
+    with op.batch_alter_table('message', schema=None) as batch_op:
+        batch_op.drop_index('ix_message_recipient_id_timestamp')
+
+    with op.batch_alter_table('post', schema=None) as batch_op:
+        batch_op.drop_index('ix_post_parent_id_timestamp')
+        batch_op.drop_index('ix_post_user_id_timestamp')
+
+    with op.batch_alter_table('likes', schema=None) as batch_op:
+        batch_op.drop_index('ix_likes_post_id')
+        batch_op.drop_constraint('pk_likes', type_='primary')
+        batch_op.alter_column('post_id', existing_type=sa.Integer(), nullable=True)
+        batch_op.alter_column('user_id', existing_type=sa.Integer(), nullable=True)
+
+    with op.batch_alter_table('followers', schema=None) as batch_op:
+        batch_op.drop_index('ix_followers_followed_id')
+        batch_op.drop_constraint('pk_followers', type_='primary')
+        batch_op.alter_column('followed_id', existing_type=sa.Integer(), nullable=True)
+        batch_op.alter_column('follower_id', existing_type=sa.Integer(), nullable=True)
@@ -0,0 +1,39 @@
+"""post mentions
+
+Revision ID: 9a3f60d2c817
+Revises: 5b7c2e91a0d4
+Create Date: 2026-10-18 10:02:17.550931
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9a3f60d2c817'
+down_revision = '5b7c2e91a0d4'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('post_mentions',
+    sa.Column('post_id', sa.Integer(), nullable=False),
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['post_id'], ['post.id'], ),
+    sa.ForeignKeyConstraint(['user_id'], ['user.id'], ),
+    sa.PrimaryKeyConstraint('post_id', 'user_id')
+    )
+    op.create_index('ix_post_mentions_user_id', 'post_mentions', ['user_id', 'post_id'], unique=False)
+    with op.batch_alter_table('post', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('body_segments', sa.Text(), nullable=True))
+
+    # existing posts are resolved with 'flask mentions backfill'
+
+
+def downgrade():
+    with op.batch_alter_table('post', schema=None) as batch_op:
+        batch_op.drop_column('body_segments')
+
+    op.drop_index('ix_post_mentions_user_id', table_name='post_mentions')
+    op.drop_table('post_mentions')
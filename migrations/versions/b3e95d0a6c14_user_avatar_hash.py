@@ -0,0 +1,38 @@
+"""user avatar hash
+
+Revision ID: b3e95d0a6c14
+Revises: 4f8a1c7e2d90
+Create Date: 2026-10-18 19:40:51.203117
+
+"""
+from hashlib import md5
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b3e95d0a6c14'
+down_revision = '4f8a1c7e2d90'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('user', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('avatar_hash', sa.String(length=32), nullable=True))
+
+    user = sa.table('user', sa.column('id', sa.Integer), sa.column('email', sa.String),
+                    sa.column('avatar_hash', sa.String))
+    conn = op.get_bind()
+    rows = conn.execute(sa.select(user.c.id, user.c.email).where(
+        user.c.email.isnot(None))).fetchall()
+    for i in range(0, len(rows), 1000):
+        conn.execute(user.update().where(user.c.id == sa.bindparam('user_id')).values(
+            avatar_hash=sa.bindparam('digest')), [
+            {'user_id': id, 'digest': md5(email.lower().encode('utf-8')).hexdigest()}
+            for id, email in rows[i:i + 1000]])
+
+
+def downgrade():
+    with op.batch_alter_table('user', schema=None) as batch_op:
+        batch_op.drop_column('avatar_hash')
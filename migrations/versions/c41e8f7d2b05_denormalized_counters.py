@@ -0,0 +1,43 @@
+"""denormalized counters
+
+Revision ID: c41e8f7d2b05
+Revises: 9a3f60d2c817
+Create Date: 2026-10-18 11:24:51.307716
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c41e8f7d2b05'
+down_revision = '9a3f60d2c817'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('user', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('followers_count', sa.Integer(), server_default='0', nullable=True))
+        batch_op.add_column(sa.Column('followed_count', sa.Integer(), server_default='0', nullable=True))
+
+    with op.batch_alter_table('post', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('likes_count', sa.Integer(), server_default='0', nullable=True))
+        batch_op.add_column(sa.Column('comments_count', sa.Integer(), server_default='0', nullable=True))
+
+    op.execute('UPDATE "user" SET '
+               'followers_count = (SELECT count(*) FROM followers WHERE followed_id = "user".id), '
+               'followed_count = (SELECT count(*) FROM followers WHERE follower_id = "user".id)')
+    op.execute('UPDATE post SET '
+               'likes_count = (SELECT count(*) FROM likes WHERE post_id = post.id), '
+               'comments_count = (SELECT count(*) FROM post AS comment WHERE comment.parent_id = post.id)')
+
+
+def downgrade():
+    with op.batch_alter_table('post', schema=None) as batch_op:
+        batch_op.drop_column('comments_count')
+        batch_op.drop_column('likes_count')
+
+    with op.batch_alter_table('user', schema=None) as batch_op:
+        batch_op.drop_column('followed_count')
+        batch_op.drop_column('followers_count')
@@ -0,0 +1,42 @@
+"""follow suggestions
+
+Revision ID: c81f4d2b7a63
+Revises: b3e95d0a6c14
+Create Date: 2026-10-18 20:31:17.405928
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c81f4d2b7a63'
+down_revision = 'b3e95d0a6c14'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('follow_suggestion',
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.Column('suggested_id', sa.Integer(), nullable=False),
+    sa.Column('score', sa.Float(), nullable=True),
+    sa.ForeignKeyConstraint(['suggested_id'], ['user.id'], ),
+    sa.ForeignKeyConstraint(['user_id'], ['user.id'], ),
+    sa.PrimaryKeyConstraint('user_id', 'suggested_id')
+    )
+    op.create_index('ix_follow_suggestion_user_id_score', 'follow_suggestion',
+                    ['user_id', 'score'], unique=False)
+
+    # every existing user starts out stale, "flask suggestions update" fills them in
+    with op.batch_alter_table('user', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('suggestions_stale', sa.Boolean(),
+                                      server_default=sa.true(), nullable=True))
+
+
+def downgrade():
+    with op.batch_alter_table('user', schema=None) as batch_op:
+        batch_op.drop_column('suggestions_stale')
+
+    op.drop_index('ix_follow_suggestion_user_id_score', table_name='follow_suggestion')
+    op.drop_table('follow_suggestion')
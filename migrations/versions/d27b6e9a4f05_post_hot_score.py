@@ -0,0 +1,49 @@
+"""post hot score
+
+Revision ID: d27b6e9a4f05
+Revises: c81f4d2b7a63
+Create Date: 2026-10-18 21:05:42.118730
+
+"""
+from datetime import datetime
+from math import log2
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd27b6e9a4f05'
+down_revision = 'c81f4d2b7a63'
+branch_labels = None
+depends_on = None
+
+# the defaults of HOT_SCORE_EPOCH, HOT_SCORE_HALF_LIFE and the weights
+EPOCH = datetime(2020, 1, 1)
+HALF_LIFE = 12 * 3600
+
+
+def upgrade():
+    with op.batch_alter_table('post', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('hot_score', sa.Float(), server_default='0',
+                                      nullable=True))
+        batch_op.create_index('ix_post_hot_score', ['hot_score', 'id'], unique=False)
+
+    # score the existing engagement as of each post's creation time
+    post = sa.table('post', sa.column('id', sa.Integer), sa.column('timestamp', sa.DateTime),
+                    sa.column('likes_count', sa.Integer), sa.column('comments_count', sa.Integer),
+                    sa.column('hot_score', sa.Float))
+    conn = op.get_bind()
+    rows = conn.execute(sa.select(post.c.id, post.c.timestamp, post.c.likes_count,
+                                  post.c.comments_count)).fetchall()
+    for i in range(0, len(rows), 1000):
+        conn.execute(post.update().where(post.c.id == sa.bindparam('post_id')).values(
+            hot_score=sa.bindparam('score')), [
+            {'post_id': id, 'score': ((timestamp or EPOCH) - EPOCH).total_seconds() / HALF_LIFE +
+             log2(1 + (likes or 0) + 2 * (comments or 0))}
+            for id, timestamp, likes, comments in rows[i:i + 1000]])
+
+
+def downgrade():
+    with op.batch_alter_table('post', schema=None) as batch_op:
+        batch_op.drop_index('ix_post_hot_score')
+        batch_op.drop_column('hot_score')
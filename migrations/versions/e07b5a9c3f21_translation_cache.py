@@ -0,0 +1,32 @@
+"""translation cache
+
+Revision ID: e07b5a9c3f21
+Revises: c41e8f7d2b05
+Create Date: 2026-10-18 13:40:08.662190
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e07b5a9c3f21'
+down_revision = 'c41e8f7d2b05'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('translation',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('body_hash', sa.String(length=64), nullable=True),
+    sa.Column('source', sa.String(length=5), nullable=True),
+    sa.Column('dest', sa.String(length=5), nullable=True),
+    sa.Column('text', sa.Text(), nullable=True),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('body_hash', 'source', 'dest', name='uq_translation_body_hash')
+    )
+
+
+def downgrade():
+    op.drop_table('translation')
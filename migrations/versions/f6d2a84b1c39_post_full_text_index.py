@@ -0,0 +1,35 @@
+"""post full text index
+
+Revision ID: f6d2a84b1c39
+Revises: e07b5a9c3f21
+Create Date: 2026-10-18 15:05:33.901427
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f6d2a84b1c39'
+down_revision = 'e07b5a9c3f21'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # index used by the 'database' search backend, see app/search.py
+    dialect = op.get_bind().dialect.name
+    if dialect == 'sqlite':
+        op.execute('CREATE VIRTUAL TABLE IF NOT EXISTS post_fts USING fts5(body)')
+        op.execute('INSERT INTO post_fts (rowid, body) SELECT id, body FROM post')
+    elif dialect == 'postgresql':
+        op.execute('CREATE TABLE IF NOT EXISTS post_fts (id INTEGER PRIMARY KEY, document TSVECTOR)')
+        op.execute('CREATE INDEX IF NOT EXISTS ix_post_fts_document ON post_fts USING GIN (document)')
+        op.execute("INSERT INTO post_fts (id, document) "
+                   "SELECT id, to_tsvector('simple', coalesce(body, '')) FROM post")
+
+
+def downgrade():
+    dialect = op.get_bind().dialect.name
+    if dialect in ('sqlite', 'postgresql'):
+        op.execute('DROP TABLE IF EXISTS post_fts')
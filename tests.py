@@ -1,12 +1,34 @@
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
+import io
+import os
+import random
+import shutil
+import tempfile
+import threading
+import time
 import unittest
-from app import create_app, db
-from app.models import User, Post
+from unittest import mock
+from flask import g
+from app import create_app, db, mail
+from app.models import User, Post, Message, Notification, Translation, followers, likes
+from app.pagination import cursor_paginate, encode_cursor
+from app.language import detect_pending
+from app.translate import translate, body_hash
+from app.search import BulkIndexer, create_search_backend
+from app.activity import LastSeenTracker
+from app.viewer import ViewerState
+from app.fragments import render_fragment
+from app.email import MailWorkerPool, MailQueueFull
+from app import bench
+from app.graph import read_edges, import_follows
+from app import suggestions
 from config import Config
 
 class TestConfig(Config):
     TESTING = True
     SQLALCHEMY_DATABASE_URI = 'sqlite://'
+    LANGUAGE_DETECTOR = 'static'
+    TRANSLATOR = 'static'
 
 class UserModelCase(unittest.TestCase):
     def setUp(self):
@@ -32,6 +54,27 @@ class UserModelCase(unittest.TestCase):
                                          'd4c74594d841139328695756648b6bd6'
                                          '?d=identicon&s=128'))
 
+    def test_avatar_hash(self):
+        u = User(username='john', email='susan@example.com')
+        u.email = 'John@Example.com'
+        self.assertEqual(u.avatar_hash, 'd4c74594d841139328695756648b6bd6')
+
+        folder = tempfile.mkdtemp()
+        self.app.config.update(AVATAR_PROXY=True, AVATAR_CACHE_DIR=folder)
+        try:
+            with open(os.path.join(folder, u.avatar_hash + '_36'), 'wb') as f:
+                f.write(b'\x89PNG cached')
+            with self.app.test_request_context():
+                url = u.avatar(36)
+            self.assertEqual(url, '/avatar/d4c74594d841139328695756648b6bd6/36')
+            response = self.app.test_client().get(url)
+            self.assertEqual(response.data, b'\x89PNG cached')
+            self.assertEqual(response.mimetype, 'image/png')
+            response.close()
+            self.assertEqual(self.app.test_client().get('/avatar/nothex/36').status_code, 404)
+        finally:
+            shutil.rmtree(folder)
+
     def test_follow(self):
         u1 = User(username='john', email='john@example.com')
         u2 = User(username='susan', email='susan@example.com')
@@ -93,5 +136,945 @@ class UserModelCase(unittest.TestCase):
         self.assertEqual(f3, [p3, p4])
         self.assertEqual(f4, [p4])
 
+    def test_timeline(self):
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        u3 = User(username='mary', email='mary@example.com')
+        db.session.add_all([u1, u2, u3])
+        db.session.commit()
+
+        now = datetime.utcnow()
+        p1 = Post(body="post from john", author=u1,
+                  timestamp=now + timedelta(seconds=1))
+        p2 = Post(body="post from susan", author=u2,
+                  timestamp=now + timedelta(seconds=2))
+        db.session.add_all([p1, p2])
+        db.session.commit()
+
+        # following backfills existing posts
+        u1.follow(u2)
+        u3.follow(u1)
+        db.session.commit()
+        self.assertEqual(u1.timeline_posts().all(), [p2, p1])
+        self.assertEqual(u3.timeline_posts().all(), [p1])
+
+        # new posts fan out to the author and their followers
+        p3 = Post(body="another post from susan", author=u2,
+                  timestamp=now + timedelta(seconds=3))
+        db.session.add(p3)
+        db.session.commit()
+        self.assertEqual(u1.timeline_posts().all(), [p3, p2, p1])
+        self.assertEqual(u2.timeline_posts().all(), [p3, p2])
+        self.assertEqual(u3.timeline_posts().all(), [p1])
+
+        # unfollowing removes the posts again
+        u1.unfollow(u2)
+        db.session.commit()
+        self.assertEqual(u1.timeline_posts().all(), [p1])
+
+        # rebuilding matches the union query
+        User.rebuild_timelines()
+        db.session.commit()
+        for u in [u1, u2, u3]:
+            self.assertEqual(u.timeline_posts().all(), u.followed_posts().all())
+
+    def test_mentions(self):
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        db.session.add_all([u1, u2])
+        db.session.commit()
+
+        p1 = Post(body="hi @susan and @nobody, mail me@example.com", author=u1)
+        p2 = Post(body="no mentions here", author=u2)
+        db.session.add_all([p1, p2])
+        db.session.commit()
+
+        self.assertEqual(p1.mentions, [u2])
+        self.assertEqual(p1.display_body_data(), [
+            ('hi ', None), ('@susan', u2), (' and ', None), ('@nobody', None),
+            (', mail me@example.com', None)])
+        self.assertEqual(p2.display_body_data(), [('no mentions here', None)])
+        self.assertEqual(u2.mentioned_in.all(), [p1])
+        self.assertEqual(u1.mentioned_in.all(), [])
+
+        # editing the body re-resolves the mentions
+        p2.body = "thanks @john"
+        db.session.commit()
+        self.assertEqual(p2.mentions, [u1])
+        self.assertEqual(u1.mentioned_in.all(), [p2])
+
+    def test_cursor_pagination(self):
+        u = User(username='john', email='john@example.com')
+        db.session.add(u)
+        now = datetime.utcnow()
+        # pairs of posts share a timestamp so the id has to break the tie
+        posts = [Post(body=str(i), author=u, timestamp=now + timedelta(seconds=i // 2))
+                 for i in range(7)]
+        db.session.add_all(posts)
+        db.session.commit()
+        newest_first = sorted(posts, key=lambda p: (p.timestamp, p.id), reverse=True)
+
+        columns = [Post.timestamp, Post.id]
+        page1 = cursor_paginate(Post.query, columns, 3)
+        self.assertEqual(page1.items, newest_first[:3])
+        self.assertFalse(page1.has_prev)
+        self.assertIsNone(page1.total)
+        page2 = cursor_paginate(Post.query, columns, 3, before=page1.next_cursor)
+        self.assertEqual(page2.items, newest_first[3:6])
+        page3 = cursor_paginate(Post.query, columns, 3, before=page2.next_cursor,
+                                with_total=True)
+        self.assertEqual(page3.items, newest_first[6:])
+        self.assertFalse(page3.has_next)
+        self.assertEqual(page3.total, 7)
+
+        # walking back returns the same pages
+        back = cursor_paginate(Post.query, columns, 3, after=page3.prev_cursor)
+        self.assertEqual(back.items, page2.items)
+        back = cursor_paginate(Post.query, columns, 3, after=back.prev_cursor)
+        self.assertEqual(back.items, page1.items)
+        self.assertFalse(back.has_prev)
+
+        # a garbled cursor falls back to the first page
+        self.assertEqual(cursor_paginate(Post.query, columns, 3, before='junk').items,
+                         page1.items)
+        # and so does one whose values don't fit the sort columns
+        for values in [[{'a': 1}, 1], [1, 1], [now, '1'], [now, True], {'a': 1}]:
+            self.assertEqual(cursor_paginate(Post.query, columns, 3,
+                                             before=encode_cursor(values)).items,
+                             page1.items, values)
+        hot = [Post.hot_score, Post.id]
+        self.assertEqual(cursor_paginate(Post.query, hot, 3, before=encode_cursor(
+            ['1', 1])).items, cursor_paginate(Post.query, hot, 3).items)
+        self.assertEqual(len(cursor_paginate(Post.query, hot, 3, before=encode_cursor(
+            [1e9, posts[0].id])).items), 3)
+
+    def test_counters(self):
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        db.session.add_all([u1, u2])
+        db.session.commit()
+        p = Post(body='post from susan', author=u2)
+        db.session.add(p)
+        db.session.commit()
+        self.assertEqual((u1.followers_count, u1.followed_count), (0, 0))
+        self.assertEqual((p.likes_count, p.comments_count), (0, 0))
+
+        u1.follow(u2)
+        u1.follow(u2)
+        u2.follow(u1)
+        u1.like_post(p)
+        u2.like_post(p)
+        db.session.add(Post(body='a comment', author=u1, parent_id=p.id))
+        db.session.add(Post(body='another comment', author=u2, parent=p))
+        db.session.commit()
+        self.assertEqual((u1.followers_count, u1.followed_count), (1, 1))
+        self.assertEqual((u2.followers_count, u2.followed_count), (1, 1))
+        self.assertEqual((p.likes_count, p.comments_count), (2, 2))
+
+        u1.unfollow(u2)
+        u2.unlike_post(p)
+        db.session.commit()
+        self.assertEqual((u1.followers_count, u1.followed_count), (1, 0))
+        self.assertEqual(u2.followers_count, 0)
+        self.assertEqual(p.likes_count, 1)
+
+        # reconcile repairs drifted counters and leaves correct ones alone
+        u1.followers_count = 7
+        p.comments_count = 0
+        db.session.commit()
+        self.assertEqual(User.reconcile_counters(1, 1000), 1)
+        self.assertEqual(Post.reconcile_counters(1, 1000), 1)
+        db.session.commit()
+        self.assertEqual(u1.followers_count, 1)
+        self.assertEqual(p.comments_count, 2)
+
+    def test_post_relations_query_count(self):
+        users = [User(username='user%d' % i, email='user%d@example.com' % i)
+                 for i in range(5)]
+        db.session.add_all(users)
+        db.session.commit()
+        for i, u in enumerate(users):
+            p = Post(body='hello @user%d' % ((i + 1) % 5), author=u)
+            db.session.add(p)
+            db.session.add(Post(body='reply', author=users[(i + 2) % 5], parent=p))
+        db.session.commit()
+        db.session.expire_all()
+
+        statements = []
+        def count(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+        db.event.listen(db.engine, 'before_cursor_execute', count)
+        try:
+            posts = Post.with_relations(Post.query).order_by(Post.id).all()
+            for post in posts:
+                post.author.username
+                post.display_body_data()
+                if post.is_comment():
+                    post.parent.author.username
+        finally:
+            db.event.remove(db.engine, 'before_cursor_execute', count)
+        self.assertEqual(len(posts), 10)
+        # one query for the posts and their authors, one for the mentions
+        self.assertEqual(len(statements), 2)
+
+    def test_language_detection(self):
+        u = User(username='john', email='john@example.com')
+        posts = [Post(body='post %d' % i, author=u) for i in range(5)]
+        posts.append(Post(body='bonjour', author=u, language='fr'))
+        db.session.add_all(posts)
+        db.session.commit()
+        self.assertIsNone(posts[0].language)
+
+        self.assertEqual(detect_pending(3), 3)
+        self.assertEqual(detect_pending(3), 2)
+        self.assertEqual(detect_pending(3), 0)
+        self.assertEqual([p.language for p in posts], ['en'] * 5 + ['fr'])
+
+        # a post the detector fails on is skipped, the rest of its batch isn't
+        detector = self.app.language_detector
+        class PickyDetector(object):
+            def detect(self, texts):
+                if 'bad' in texts:
+                    raise ValueError('bad text')
+                return detector.detect(texts)
+        self.app.language_detector = PickyDetector()
+        more = [Post(body=body, author=u) for body in ['one', 'bad', 'two']]
+        db.session.add_all(more)
+        db.session.commit()
+        with self.assertLogs(self.app.logger, 'WARNING'):
+            self.assertEqual(detect_pending(3), 3)
+        self.assertEqual([p.language for p in more], ['en', '', 'en'])
+        self.assertEqual(detect_pending(3), 0)
+
+    def test_translation_cache(self):
+        calls = []
+        translator = self.app.translator
+        class CountingTranslator(object):
+            def translate(self, texts, src, dest):
+                calls.append(list(texts))
+                return translator.translate(texts, src, dest)
+        self.app.translator = CountingTranslator()
+        cache = self.app.translation_cache
+
+        self.assertEqual(translate(['hola', 'adios'], 'es', 'en'),
+                         ['[en] hola', '[en] adios'])
+        self.assertEqual(calls, [['hola', 'adios']])
+        self.assertEqual(cache.stats['misses'], 2)
+
+        # second request is served from memory, new text goes out alone
+        self.assertEqual(translate(['adios', 'gracias'], 'es', 'en'),
+                         ['[en] adios', '[en] gracias'])
+        self.assertEqual(calls[-1], ['gracias'])
+        self.assertEqual(cache.stats['memory_hits'], 1)
+
+        # a cold process falls back to the translation table
+        cache.entries.clear()
+        self.assertEqual(translate(['hola'], 'es', 'en'), ['[en] hola'])
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(cache.stats['database_hits'], 1)
+
+        # a row another process stored first doesn't lose the rest of the batch
+        db.session.add(Translation(body_hash=body_hash('uno'), source='es', dest='en',
+                                   text='[en] uno'))
+        db.session.commit()
+        self.assertEqual(translate(['uno', 'dos'], 'es', 'en'), ['[en] uno', '[en] dos'])
+        self.assertEqual(Translation.query.filter_by(source='es', dest='en').count(), 5)
+
+    def test_translate_batch(self):
+        u = User(username='john', email='john@example.com')
+        db.session.add(u)
+        db.session.commit()
+        self.app.config['SECRET_KEY'] = 'translate'
+        client = self.app.test_client()
+        with client.session_transaction() as session:
+            session['_user_id'] = str(u.id)
+
+        def post(data):
+            with self.app.app_context():
+                return client.post('/translate/batch', json=data)
+        response = post({'dest_language': 'en', 'items': [
+            {'id': 1, 'text': 'hola', 'source_language': 'es'},
+            {'id': '2', 'text': 'salut', 'source_language': 'fr'}]})
+        self.assertEqual(response.get_json(),
+                         {'translations': {'1': '[en] hola', '2': '[en] salut'}})
+
+        item = {'id': 1, 'text': 'hola', 'source_language': 'es'}
+        for data in [None, [], {'items': [item]}, {'dest_language': 'en'},
+                     {'dest_language': 'en', 'items': [{'id': 1}]},
+                     {'dest_language': 'en', 'items': ['hola']},
+                     {'dest_language': 'en', 'items': [dict(item, text='x' * 1001)]},
+                     {'dest_language': 'english', 'items': [item]},
+                     {'dest_language': 'en', 'items': [dict(item, source_language='spanish')]},
+                     {'dest_language': 'en', 'items': [item] * 101}]:
+            self.assertEqual(post(data).status_code, 400, data)
+
+    def test_bulk_indexer(self):
+        sent = []
+        class FlakyIndexer(BulkIndexer):
+            def send(self, batch):
+                sent.append(dict(batch))
+                # the first attempt at document 2 fails
+                return [('post', 2)] if len(sent) == 1 else []
+        indexer = FlakyIndexer(self.app, None)
+
+        indexer.add('post', 1, {'body': 'first'})
+        indexer.add('post', 2, {'body': 'second'})
+        indexer.add('post', 1, {'body': 'first, edited'})
+        indexer.remove('post', 3)
+        self.assertEqual(indexer.flush(), 2)
+        self.assertEqual(sent[0], {('post', 1): {'body': 'first, edited'},
+                                   ('post', 2): {'body': 'second'},
+                                   ('post', 3): None})
+
+        # the failed document is retried on the next flush
+        self.assertEqual(indexer.flush(), 1)
+        self.assertEqual(sent[1], {('post', 2): {'body': 'second'}})
+        self.assertEqual(indexer.flush(), 0)
+        self.assertEqual(len(sent), 2)
+
+    def test_database_search(self):
+        u = User(username='john', email='john@example.com')
+        p1 = Post(body='the cat sat on the mat', author=u)
+        p2 = Post(body='cat cat cat', author=u)
+        p3 = Post(body='nothing to see here', author=u)
+        db.session.add_all([u, p1, p2, p3])
+        db.session.commit()
+
+        posts, total = Post.search('cat', 1, 10)
+        self.assertEqual(total, 2)
+        self.assertEqual(posts.all(), [p2, p1])
+        posts, total = Post.search('cat', 2, 1)
+        self.assertEqual((posts.all(), total), ([p1], 2))
+        self.assertEqual(Post.search('"cat" -', 1, 10)[1], 2)
+
+        # edits and deletes go through the commit hooks
+        p3.body = 'a cat after all'
+        db.session.delete(p2)
+        db.session.commit()
+        posts, total = Post.search('cat', 1, 10)
+        self.assertEqual(total, 2)
+        self.assertEqual(set(posts.all()), {p1, p3})
+
+        Post.reindex()
+        self.assertEqual(Post.search('mat', 1, 10)[1], 1)
+
+        # only searchable columns trigger a reindex, in one batch per commit
+        backend = self.app.search_backend
+        with mock.patch.object(backend, 'update', wraps=backend.update) as update:
+            u.like_post(p1)
+            db.session.commit()
+            update.assert_not_called()
+            p1.body = 'the dog sat on the mat'
+            db.session.flush()
+            p3.body = 'no dog here'
+            db.session.commit()
+            update.assert_called_once_with({
+                ('post', p1.id): {'body': 'the dog sat on the mat'},
+                ('post', p3.id): {'body': 'no dog here'}})
+            p1.body = 'rolled back'
+            db.session.flush()
+            db.session.rollback()
+            db.session.commit()
+            self.assertEqual(update.call_count, 1)
+        self.assertEqual(Post.search('dog', 1, 10)[1], 2)
+
+        # reindexing writes one batch per SEARCH_INDEX_BATCH_SIZE posts
+        self.app.config['SEARCH_INDEX_BATCH_SIZE'] = 1
+        with mock.patch.object(backend, 'update', wraps=backend.update) as update:
+            Post.reindex()
+            self.assertEqual(update.call_count, 2)
+
+        # an index failure doesn't undo or fail the committed write
+        with mock.patch.object(backend, 'update', side_effect=RuntimeError('down')):
+            with self.assertLogs(self.app.logger, 'ERROR'):
+                p1.body = 'a bird'
+                db.session.commit()
+        self.assertEqual(Post.query.get(p1.id).body, 'a bird')
+
+        # databases without full text support get no search backend
+        uri = self.app.config['SQLALCHEMY_DATABASE_URI']
+        self.app.config['SQLALCHEMY_DATABASE_URI'] = 'mysql://localhost/microblog'
+        try:
+            with self.assertLogs(self.app.logger, 'WARNING'):
+                self.assertIsNone(create_search_backend(self.app))
+        finally:
+            self.app.config['SQLALCHEMY_DATABASE_URI'] = uri
+
+    def test_last_seen_tracker(self):
+        now = datetime.utcnow()
+        u1 = User(username='john', email='john@example.com',
+                  last_seen=now - timedelta(hours=1))
+        u2 = User(username='susan', email='susan@example.com',
+                  last_seen=now - timedelta(seconds=5))
+        db.session.add_all([u1, u2])
+        db.session.commit()
+
+        tracker = LastSeenTracker(self.app)
+        tracker.touch(u1)
+        tracker.touch(u1)
+        tracker.touch(u2)
+        # recent enough users are skipped and nothing is written yet
+        self.assertEqual(list(tracker.pending), [u1.id])
+        self.assertLess(u1.last_seen, now)
+
+        self.assertEqual(tracker.flush(), 1)
+        self.assertGreaterEqual(u1.last_seen, now)
+        self.assertLess(u2.last_seen, now)
+        self.assertEqual(tracker.flush(), 0)
+
+        # a failed write is logged and the batch is kept for the next flush
+        tracker.resolution = 0
+        tracker.touch(u2)
+        with mock.patch.object(db.session, 'commit', side_effect=RuntimeError('down')):
+            with self.assertLogs(self.app.logger, 'ERROR'):
+                self.assertEqual(tracker.flush(), 0)
+        self.assertEqual(list(tracker.pending), [u2.id])
+        self.assertEqual(tracker.flush(), 1)
+        self.assertGreaterEqual(u2.last_seen, now)
+
+    def test_notification_broker(self):
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        db.session.add_all([u1, u2])
+        db.session.commit()
+        broker = self.app.notification_broker
+        s1 = broker.subscribe(u1.id)
+        s2 = broker.subscribe(u2.id)
+
+        # nothing is published until the notification is committed
+        u1.add_notification('unread_message_count', 1)
+        self.assertFalse(s1.wait(0))
+        db.session.commit()
+        self.assertTrue(s1.wait(0))
+        self.assertFalse(s1.wait(0))
+        self.assertFalse(s2.wait(0))
+
+        u2.add_notification('unread_message_count', 1)
+        db.session.rollback()
+        db.session.commit()
+        self.assertFalse(s2.wait(0))
+
+        s1.close()
+        s2.close()
+        self.assertEqual(broker.subscriptions, {})
+
+        # a notification written by another process doesn't wake up the local
+        # broker, open streams still find it when they check the database
+        self.app.config['SECRET_KEY'] = 'stream'
+        self.app.config['NOTIFICATION_KEEPALIVE'] = 0.01
+        client = self.app.test_client()
+        with client.session_transaction() as session:
+            session['_user_id'] = str(u2.id)
+        chunks = iter(client.get('/notifications/stream?since=%f' % time.time(),
+                                 buffered=False).response)
+        self.assertEqual(next(chunks), b'retry: 5000\n\n')
+        self.assertEqual(next(chunks), b': keepalive\n\n')
+        db.session.add(Notification(name='other', user=u2, payload_json='2'))
+        db.session.commit()
+        self.assertIn(b'"name": "other"', next(chunks))
+
+    def test_unread_messages(self):
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        u3 = User(username='mary', email='mary@example.com')
+        db.session.add_all([u1, u2, u3])
+        db.session.commit()
+        self.assertEqual(u1.new_messages(), 0)
+
+        for sender in [u2, u2, u3]:
+            db.session.add(Message(sender=sender, recipient=u1, body='hi'))
+            u1.add_unread_message(sender)
+            u1.add_notification('unread_message_count', u1.new_messages())
+            db.session.commit()
+        self.assertEqual(u1.new_messages(), 3)
+        self.assertEqual(u1.new_messages_by_sender(), {u2.id: 2, u3.id: 1})
+        # the notification row is updated in place
+        self.assertEqual(u1.notifications.count(), 1)
+        self.assertEqual(u1.notifications.first().get_data(), 3)
+
+        u1.mark_messages_read(u2)
+        db.session.commit()
+        self.assertEqual(u1.new_messages_by_sender(), {u3.id: 1})
+        u1.mark_messages_read()
+        db.session.commit()
+        self.assertEqual(u1.new_messages(), 0)
+        self.assertIsNotNone(u1.last_message_read_time)
+
+    def query_plan(self, query):
+        statement = getattr(query, 'statement', query).compile(dialect=db.engine.dialect)
+        params = tuple(statement.params[name] for name in statement.positiontup)
+        rows = db.session.connection().exec_driver_sql(
+            'EXPLAIN QUERY PLAN ' + str(statement), params)
+        return ' '.join(row[-1] for row in rows)
+
+    def test_access_path_indexes(self):
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        db.session.add_all([u1, u2])
+        db.session.commit()
+        p = Post(body='post', author=u1)
+        db.session.add(p)
+        db.session.commit()
+
+        plans = {
+            'ix_followers_followed_id': u1.followers,
+            'sqlite_autoindex_followers_1': db.select(followers.select().where(
+                followers.c.follower_id == u1.id,
+                followers.c.followed_id == u2.id).exists()),
+            'sqlite_autoindex_likes_1': db.select(likes.select().where(
+                likes.c.user_id == u1.id, likes.c.post_id == p.id).exists()),
+            'ix_post_user_id_timestamp': u1.get_posts().order_by(Post.timestamp.desc()),
+            'ix_post_parent_id_timestamp': p.comments.order_by(Post.timestamp.desc()),
+            'ix_message_recipient_id_timestamp':
+                u1.messages_received.order_by(Message.timestamp.desc()),
+            'ix_notification_user_id_timestamp': Notification.since(u1.id, 0),
+            'ix_timeline_user_id_timestamp': u1.timeline_posts(),
+            'ix_post_mentions_user_id': u1.mentioned_in,
+        }
+        for index, query in plans.items():
+            plan = self.query_plan(query)
+            self.assertIn(index, plan)
+            self.assertNotIn('SCAN', plan.replace('SCAN CONSTANT ROW', ''))
+
+    def test_viewer_state(self):
+        users = [User(username='user%d' % i, email='user%d@example.com' % i)
+                 for i in range(4)]
+        db.session.add_all(users)
+        db.session.commit()
+        posts = [Post(body='post', author=u) for u in users]
+        db.session.add_all(posts)
+        db.session.commit()
+        viewer = users[0]
+        viewer.follow(users[1])
+        viewer.follow(users[2])
+        viewer.like_post(posts[1])
+        viewer.like_post(posts[3])
+        db.session.commit()
+        posts = Post.with_relations(Post.query).order_by(Post.id).all()
+        users = [p.author for p in posts]
+
+        statements = []
+        def count(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+        db.event.listen(db.engine, 'before_cursor_execute', count)
+        try:
+            state = ViewerState(viewer)
+            state.load(posts=posts)
+            liked = [state.liked(p) for p in posts]
+            following = [state.following(u) for u in users]
+        finally:
+            db.event.remove(db.engine, 'before_cursor_execute', count)
+        self.assertEqual(liked, [False, True, False, True])
+        self.assertEqual(following, [False, True, True, False])
+        # one query for the likes, one for the follows of the post authors
+        self.assertEqual(len(statements), 2)
+
+    def test_fragment_cache(self):
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        db.session.add_all([u1, u2])
+        db.session.commit()
+        p = Post(body='hi @susan', author=u1, language='es')
+        db.session.add(p)
+        db.session.commit()
+
+        cache = self.app.fragment_cache
+        def render(locale='en'):
+            with self.app.test_request_context():
+                g.locale = locale
+                g.viewer = ViewerState(u1)
+                return str(render_fragment('post', p))
+        html = render()
+        self.assertIn('/user/susan', html)
+        self.assertEqual(render(), html)
+        self.assertEqual(cache.stats, {'hits': 1, 'misses': 1})
+
+        # the translate link depends on the locale
+        self.assertNotIn('Translate', render('es'))
+        self.assertEqual(cache.stats['misses'], 2)
+
+        u2.username = 'sue'
+        db.session.commit()
+        self.assertIn('/user/sue"', render())
+        p.body = 'bye'
+        db.session.commit()
+        self.assertEqual(p.version, 2)
+        self.assertIn('bye', render())
+        self.assertEqual(cache.stats, {'hits': 1, 'misses': 4})
+
+    def test_mail_worker_pool(self):
+        self.app.config.update(MAIL_WORKERS=1, MAIL_QUEUE_SIZE=2, MAIL_QUEUE_TIMEOUT=0.01)
+        pool = MailWorkerPool(self.app)
+        connections = []
+        release = threading.Event()
+        class Connection(object):
+            def __enter__(self):
+                connections.append([])
+                return self
+            def __exit__(self, *args):
+                pass
+            def send(self, msg):
+                release.wait()
+                connections[-1].append(msg)
+        with mock.patch.object(mail, 'connect', Connection):
+            pool.submit(0)
+            while pool.queue.qsize():
+                time.sleep(0.01)
+            # the worker is busy sending, two more messages fill the queue
+            pool.submit(1)
+            pool.submit(2)
+            self.assertRaises(MailQueueFull, pool.submit, 3)
+            release.set()
+            pool.drain()
+        metrics = pool.metrics()
+        self.assertEqual(metrics['sent'], 3)
+        self.assertEqual(metrics['rejected'], 1)
+        self.assertEqual(metrics['queue_depth'], 0)
+        # every message went over the same connection
+        self.assertEqual(connections, [[0, 1, 2]])
+
+    def test_bench(self):
+        created = bench.seed(users=12, follows=4, posts=3, comments=2, likes_per_user=4)
+        self.assertEqual(User.query.count(), 12)
+        self.assertEqual(Post.query.count(), created['posts'] + created['comments'])
+        u = User.query.order_by(User.followers_count.desc()).first()
+        self.assertEqual(u.followers_count, u.followers.count())
+
+        self.app.config['SECRET_KEY'] = 'bench'
+        results = bench.run(self.app, requests=2, warmup=1)
+        self.assertEqual(set(results['routes']), set(bench.routes(
+            random.Random(), u, [u], [1])))
+        for name, route in results['routes'].items():
+            self.assertEqual(route['errors'], 0, name)
+            self.assertEqual(route['requests'], 2)
+            self.assertGreater(route['queries']['mean'], 0)
+
+    def test_instrumentation(self):
+        self.assertFalse(self.app.instrumentation.enabled)
+        self.assertEqual(self.app.test_client().get('/metrics').status_code, 404)
+
+        class MetricsConfig(TestConfig):
+            SECRET_KEY = 'metrics'
+            METRICS_ENABLED = True
+            METRICS_SERVER_TIMING = True
+            SLOW_REQUEST_THRESHOLD = 0
+        app = create_app(MetricsConfig)
+        with app.app_context():
+            db.create_all()
+            u = User(username='john', email='john@example.com')
+            db.session.add(u)
+            db.session.commit()
+            with app.instrumentation.timer('translate'):
+                pass
+            client = app.test_client()
+            with client.session_transaction() as session:
+                session['_user_id'] = str(u.id)
+            with self.assertLogs(app.logger, 'WARNING') as logs:
+                with app.app_context():
+                    response = client.get('/explore')
+            self.assertEqual(response.status_code, 200)
+            timing = response.headers['Server-Timing']
+            self.assertRegex(timing, r'sql;dur=[\d.]+;desc="\d+ queries", tpl;dur=[\d.]+')
+            self.assertIn('Slow request GET /explore', logs.output[0])
+
+            metrics = client.get('/metrics').get_data(as_text=True)
+            self.assertIn('microblog_requests_total{endpoint="main.explore",'
+                          'method="GET",status="200"} 1', metrics)
+            self.assertIn('microblog_request_duration_seconds_count{endpoint="main.explore"} 1',
+                          metrics)
+            self.assertRegex(metrics, r'microblog_sql_statements_total\{endpoint="main.explore"\} [1-9]')
+            self.assertIn('microblog_external_calls_total{service="translate"} 1', metrics)
+            db.drop_all()
+
+    def test_replica_routing(self):
+        folder = tempfile.mkdtemp()
+        class ReplicaConfig(TestConfig):
+            SECRET_KEY = 'replica'
+            WTF_CSRF_ENABLED = False
+            SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(folder, 'primary.db')
+            DATABASE_REPLICA_URL = 'sqlite:///' + os.path.join(folder, 'replica.db')
+        app = create_app(ReplicaConfig)
+        try:
+            with app.app_context():
+                primary, replica = db.engines[None], db.engines['replica']
+                for engine in (primary, replica):
+                    db.metadata.create_all(engine)
+                    with engine.begin() as conn:
+                        conn.execute(User.__table__.insert().values(
+                            id=1, username='john', email='john@example.com'))
+                with primary.connect() as conn:
+                    self.assertEqual(conn.exec_driver_sql('PRAGMA journal_mode').scalar(), 'wal')
+                    self.assertEqual(conn.exec_driver_sql('PRAGMA synchronous').scalar(), 1)
+                    self.assertEqual(conn.exec_driver_sql('PRAGMA busy_timeout').scalar(), 5000)
+                with primary.begin() as conn:
+                    conn.execute(Post.__table__.insert().values(body='primary only', user_id=1))
+
+            def explore(client):
+                with client.session_transaction() as session:
+                    session['_user_id'] = '1'
+                with app.app_context():
+                    return client.get('/explore').get_data(as_text=True)
+            client = app.test_client()
+            self.assertNotIn('primary only', explore(client))
+            with app.app_context():
+                self.assertEqual(client.post('/index', data={'post': 'new post'}).status_code, 302)
+            # the client that wrote reads from the primary for a while, others don't
+            page = explore(client)
+            self.assertIn('primary only', page)
+            self.assertIn('new post', page)
+            self.assertNotIn('new post', explore(app.test_client()))
+        finally:
+            with app.app_context():
+                db.session.remove()
+                for engine in db.engines.values():
+                    engine.dispose()
+            # the bind registered its metadata on the shared db object
+            db.metadatas.pop('replica', None)
+            shutil.rmtree(folder)
+
+    def test_api(self):
+        self.app.config['SECRET_KEY'] = 'api'
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        u1.set_password('cat')
+        db.session.add_all([u1, u2])
+        db.session.commit()
+        now = datetime.utcnow()
+        posts = [Post(body='post %d' % i, author=u2, timestamp=now + timedelta(seconds=i))
+                 for i in range(3)]
+        db.session.add_all(posts)
+        db.session.add(Message(sender=u2, recipient=u1, body='hi', timestamp=now))
+        u1.follow(u2)
+        db.session.commit()
+
+        client = self.app.test_client()
+        with self.app.app_context():
+            # its own context, so the anonymous user isn't cached for later requests
+            self.assertEqual(client.get('/api/posts').status_code, 401)
+        self.assertEqual(client.post('/api/tokens', auth=('john', 'dog')).status_code, 401)
+        token = client.post('/api/tokens', auth=('john', 'cat')).get_json()['token']
+        headers = {'Authorization': 'Bearer ' + token}
+
+        response = client.get('/api/timeline?per_page=2', headers=headers)
+        data = response.get_json()
+        self.assertEqual([p['body'] for p in data['items']], ['post 2', 'post 1'])
+        self.assertEqual(data['items'][0]['author'], 'susan')
+        self.assertIsNone(data['_links']['prev'])
+        data = client.get(data['_links']['next'], headers=headers).get_json()
+        self.assertEqual([p['body'] for p in data['items']], ['post 0'])
+        # a negative LIMIT would mean no limit at all
+        for per_page, count in (-3, 1), (0, 1), (1000, 3):
+            data = client.get('/api/posts?per_page=%d' % per_page, headers=headers).get_json()
+            self.assertEqual(len(data['items']), count)
+
+        # unchanged resources answer conditional requests with 304
+        response = client.get('/api/users/susan', headers=headers)
+        self.assertEqual(response.get_json()['followers'], 1)
+        etag = response.headers['ETag']
+        response = client.get('/api/users/susan', headers=dict(headers, **{'If-None-Match': etag}))
+        self.assertEqual(response.status_code, 304)
+        u1.unfollow(u2)
+        db.session.commit()
+        response = client.get('/api/users/susan', headers=dict(headers, **{'If-None-Match': etag}))
+        self.assertEqual(response.status_code, 200)
+
+        response = client.get('/api/messages', headers=headers)
+        self.assertEqual(response.get_json()['items'][0]['sender'], 'susan')
+        self.assertEqual(response.last_modified, now.replace(microsecond=0, tzinfo=timezone.utc))
+        response = client.get('/api/messages', headers=dict(
+            headers, **{'If-Modified-Since': response.headers['Last-Modified']}))
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(client.get('/api/posts/999', headers=headers).get_json(),
+                         {'error': 'Not Found'})
+
+    def test_popup_caching(self):
+        self.app.config['SECRET_KEY'] = 'popup'
+        self.app.config['LIKES_POPUP_USERS'] = 2
+        users = [User(username=name, email=name + '@example.com')
+                 for name in ('john', 'susan', 'mary', 'david')]
+        db.session.add_all(users)
+        p = Post(body='hello', author=users[1])
+        db.session.add(p)
+        db.session.commit()
+        for u in users:
+            u.like_post(p)
+        db.session.commit()
+
+        client = self.app.test_client()
+        with client.session_transaction() as session:
+            session['_user_id'] = str(users[0].id)
+        response = client.get('/user/susan/popup')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.cache_control.max_age, 60)
+        self.assertTrue(response.cache_control.private)
+        etag = {'If-None-Match': response.headers['ETag']}
+        response = client.get('/user/susan/popup', headers=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.get_data(), b'')
+        users[0].follow(users[1])
+        db.session.commit()
+        self.assertEqual(client.get('/user/susan/popup', headers=etag).status_code, 200)
+        users[1].about_me = 'changed'
+        db.session.commit()
+        etag = {'If-None-Match': client.get('/user/susan/popup').headers['ETag']}
+        users[1].about_me = 'changed again'
+        db.session.commit()
+        self.assertEqual(client.get('/user/susan/popup', headers=etag).status_code, 200)
+
+        response = client.get('/post/{}/likes_popup'.format(p.id))
+        html = response.get_data(as_text=True)
+        self.assertIn('john', html)
+        self.assertNotIn('mary', html)
+        self.assertIn('and 2 more', html)
+        etag = {'If-None-Match': response.headers['ETag']}
+        self.assertEqual(client.get('/post/{}/likes_popup'.format(p.id),
+                                    headers=etag).status_code, 304)
+        users[0].username = 'johnny'
+        db.session.commit()
+        response = client.get('/post/{}/likes_popup'.format(p.id), headers=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('johnny', response.get_data(as_text=True))
+
+    def test_bulk_follow(self):
+        self.app.config['SECRET_KEY'] = 'graph'
+        users = [User(username='user%d' % i, email='user%d@example.com' % i) for i in range(4)]
+        users[0].set_password('cat')
+        db.session.add_all(users)
+        db.session.commit()
+        db.session.add_all([Post(body='post %d' % i, author=u) for i, u in enumerate(users)])
+        users[0].follow(users[1])
+        db.session.commit()
+        u0, u1, u2, u3 = [u.id for u in users]
+
+        new = User.add_follows([(u0, u1), (u0, u2), (u0, u2), (u0, u0), (u3, u2)])
+        db.session.commit()
+        self.assertEqual(new, [(u0, u2), (u3, u2)])
+        self.assertEqual([(u.followed_count, u.followers_count) for u in users],
+                         [(2, 0), (0, 1), (0, 2), (1, 0)])
+        self.assertEqual([p.body for p in users[0].timeline_posts()],
+                         ['post 2', 'post 1', 'post 0'])
+        self.assertEqual(User.remove_follows([(u0, u2), (u0, u3)]), [(u0, u2)])
+        db.session.commit()
+        self.assertEqual((users[0].followed_count, users[2].followers_count), (1, 1))
+        self.assertEqual(users[0].timeline_posts().count(), 2)
+
+        client = self.app.test_client()
+        token = client.post('/api/tokens', auth=('user0', 'cat')).get_json()['token']
+        headers = {'Authorization': 'Bearer ' + token}
+        response = client.post('/api/following', headers=headers,
+                               json={'usernames': ['user1', 'user2', 'user3', 'nobody']})
+        self.assertEqual(response.get_json(), {'followed': ['user2', 'user3'],
+                                               'unknown': ['nobody']})
+        response = client.delete('/api/following', headers=headers,
+                                 json={'usernames': ['user3']})
+        self.assertEqual(response.get_json(), {'unfollowed': ['user3'], 'unknown': []})
+        self.assertEqual(client.post('/api/following', headers=headers,
+                                     json={'usernames': 'user1'}).status_code, 400)
+        self.assertEqual(users[0].followed_count, 2)
+
+        csv_file = io.StringIO('follower,followed\nuser1,user2\nuser1,ghost\nuser3,user1\n')
+        stats = list(import_follows(read_edges(csv_file, 'csv'), batch_size=2))
+        self.assertEqual(len(stats), 2)
+        self.assertEqual({k: stats[-1][k] for k in ('edges', 'followed', 'existing', 'unknown')},
+                         {'edges': 3, 'followed': 2, 'existing': 0, 'unknown': 1})
+        ndjson = io.StringIO('{"follower": "user1", "followed": "user2"}\n\n'
+                             '{"follower": "user2", "followed": "user3"}\n')
+        stats = list(import_follows(read_edges(ndjson, 'ndjson')))[-1]
+        self.assertEqual((stats['followed'], stats['existing']), (1, 1))
+        self.assertEqual(User.reconcile_counters(u0, u3), 0)
+        with self.assertRaises(ValueError):
+            list(read_edges(io.StringIO('a,b\nuser1,user2\n'), 'csv'))
+
+    def test_follow_suggestions(self):
+        self.app.config['SECRET_KEY'] = 'suggestions'
+        a, b, c, d, e = users = [User(username=name, email=name + '@example.com')
+                                 for name in ('a', 'b', 'c', 'd', 'e')]
+        db.session.add_all(users)
+        p = Post(body='liked', author=b)
+        db.session.add(p)
+        db.session.commit()
+        a.follow(b)
+        b.follow(c)
+        b.follow(d)
+        for u in (a, d, e):
+            u.like_post(p)
+        db.session.commit()
+
+        # c is followed by b, d is followed by b and liked p, e liked p
+        follows, post_likes = suggestions.load_neighborhood([a.id])
+        expected = {a.id: [(d.id, 1.5), (c.id, 1), (e.id, 0.5)]}
+        self.assertEqual(suggestions._score_python([a.id], follows, post_likes, 10, 0.5),
+                         expected)
+        if suggestions.sparse is not None:
+            self.assertEqual(suggestions._score_sparse([a.id], follows, post_likes, 10, 0.5),
+                             expected)
+
+        self.assertEqual(list(suggestions.update_stale(batch_size=2))[-1][0], 5)
+        self.assertFalse(User.query.filter(User.suggestions_stale).count())
+        self.assertEqual(a.suggested_users(5).all(), [d, c, e])
+        self.assertEqual(list(suggestions.update_stale()), [])
+
+        a.follow(d)
+        db.session.commit()
+        self.assertTrue(a.suggestions_stale)
+        self.assertEqual(a.suggested_users(5).all(), [c, e])
+        client = self.app.test_client()
+        with client.session_transaction() as session:
+            session['_user_id'] = str(a.id)
+        html = client.get('/index').get_data(as_text=True)
+        self.assertIn('Who to follow', html)
+        self.assertIn('/follow/c', html)
+
+    def test_hot_score(self):
+        self.app.config['SECRET_KEY'] = 'hot'
+        users = [User(username='user%d' % i, email='user%d@example.com' % i) for i in range(7)]
+        now = datetime.utcnow()
+        old = Post(body='old post', author=users[0], timestamp=now - timedelta(days=3))
+        new = Post(body='new post', author=users[0], timestamp=now - timedelta(minutes=5))
+        db.session.add_all(users + [old, new])
+        db.session.commit()
+
+        def engagement(post):
+            return 2 ** (post.hot_score - Post.hot_value(1, datetime.utcnow()))
+
+        # with 12 hour half lives the post itself counts 1/64 after 3 days
+        users[1].like_post(old)
+        for u in users[1:]:
+            u.like_post(new)
+        db.session.commit()
+        self.assertAlmostEqual(engagement(old), 1 + 2 ** -6, places=3)
+        self.assertAlmostEqual(engagement(new), 6 + 2 ** (-5 / 720), places=3)
+        self.assertEqual(Post.query.order_by(Post.hot_score.desc()).all(), [new, old])
+
+        users[1].unlike_post(old)
+        db.session.add(Post(body='a reply', author=users[1], parent=old))
+        db.session.commit()
+        self.assertAlmostEqual(engagement(old), 2 + 2 ** -6, places=3)
+        users[2].unlike_post(new)
+        db.session.commit()
+        self.assertAlmostEqual(engagement(new), 5 + 2 ** (-5 / 720), places=3)
+
+        # a score changed by another transaction is read again, not overwritten
+        db.session.execute(Post.__table__.update().where(Post.__table__.c.id == new.id).values(
+            hot_score=Post.hot_value(10, datetime.utcnow())))
+        users[2].like_post(new)
+        db.session.commit()
+        self.assertAlmostEqual(engagement(new), 11, places=3)
+
+        client = self.app.test_client()
+        with client.session_transaction() as session:
+            session['_user_id'] = str(users[0].id)
+        html = client.get('/explore?sort=hot').get_data(as_text=True)
+        self.assertLess(html.index('new post'), html.index('old post'))
+        self.assertLess(html.index('old post'), html.index('a reply'))
+        plan = self.query_plan(Post.query.order_by(Post.hot_score.desc(), Post.id.desc()))
+        self.assertIn('ix_post_hot_score', plan)
+        self.assertNotIn('TEMP B-TREE', plan)
+
+        # a post deleted by another transaction stops the retries
+        db.session.execute(Post.__table__.delete().where(Post.__table__.c.id == old.id))
+        old.add_hot_score(1)
+        self.assertIsNone(db.session.query(Post.id).filter(Post.id == old.id).first())
+
 if __name__ == '__main__':
     unittest.main(verbosity=2)
\ No newline at end of file